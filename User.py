@@ -1,18 +1,31 @@
+import sys
 
 
 class User(object):
-    """This class is used to describe a user which contains a nick, address, and room list"""
+    """
+    This class is used to describe a user which contains a nick, address, and room list.
+    Nicks and room names are interned, a room's name is then one string however
+    many members list it.
+    """
+
+    __slots__ = ("nick", "address", "rooms", "session", "wire", "outbox", "worker", "bucket", "heard")
 
     def __init__(self, nick, address):
-        self.nick = nick
+        self.nick = sys.intern(nick)
         self.address = address
-        self.rooms = [nick] # server is the help screen/list items
+        self.rooms = [] # the rooms the user has joined
+        self.session = None # set when the user connected in session mode
+        self.wire = 1 # protocol.WIRE_TEXT, or WIRE_BINARY when negotiated at CONNECT
+        self.outbox = None # the server's queue of packets on their way to the user
+        self.worker = None # the server worker process the user is connected to, None for this one
+        self.bucket = None # the server's rate limit for the user, made on their first message
+        self.heard = None # the last idle tick this worker told the user's own worker about them
 
     def join_room(self, room):
         if self.rooms is None:
-            self.rooms = [room]
+            self.rooms = [sys.intern(room)]
         elif room not in self.rooms:
-            self.rooms.append(room)
+            self.rooms.append(sys.intern(room))
 
     def leave_room(self, room):
         if self.rooms is None:
@@ -0,0 +1,547 @@
+"""
+Benchmarks for the server's hot paths. Run one with
+
+    python benchmark.py fanout
+    python benchmark.py codec [--save | --check]
+    python benchmark.py snapshot [--users N]
+    python benchmark.py memory [--users N] [--rooms-per-user N]
+    python benchmark.py compression [--room-sizes 10,100,1000]
+    python benchmark.py stress [--threads N] [--operations N]
+    python benchmark.py broadcast [--broadcast-users N] [--broadcast-rooms N]
+
+stress exits non-zero when the state store is left inconsistent.
+
+codec --save records the results as the baseline in benchmark_baseline.json,
+codec --check exits non-zero when any result falls more than --tolerance
+below it. Each case is timed in turn with a reference workload and kept as
+its speed relative to it, which absorbs a machine running faster or slower,
+but baselines are best compared on the machine they were saved on.
+
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import metrics
+import protocol
+import server
+import snapshot
+import state
+from protocol import Status
+
+
+def legacy_write(sock, packet):
+    """the per-recipient write fan-out used before encode-once: str() and a text wrapper each time"""
+    with sock.makefile('w') as wfile:
+        wfile.write(packet.__str__())
+
+
+def encode_once_write(sock, data):
+    """the current per-recipient write: the shared bytes go out in one vectored send"""
+    server.write_buffers(sock, [data])
+
+
+def allocated(fn, *args):
+    """
+    measure the bytes fn allocates while it runs, freed or not
+
+    :return: peak traced memory above what was allocated before the call
+    """
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    fn(*args)
+    return tracemalloc.get_traced_memory()[1] - before
+
+
+def bench_fanout(args):
+    """
+    bytes allocated per recipient fanning one room message out to
+    args.members recipients, before and after encode-once
+    """
+    packet = protocol.Message("lisa", "hello room " * 8, "room", status=Status.OK)
+
+    tracemalloc.start()
+    totals = {"before": 0, "after": 0}
+
+    # the after path encodes once for the whole room
+    data = [None]
+
+    def encode():
+        data[0] = packet.encode()
+    totals["after"] += allocated(encode)
+
+    for _ in range(args.members):
+        for name in totals:
+            s, r = socket.socketpair()
+            if name == "before":
+                totals[name] += allocated(legacy_write, s, packet)
+            else:
+                totals[name] += allocated(encode_once_write, s, data[0])
+            s.close()
+            r.close()
+    tracemalloc.stop()
+
+    print("fan-out of a {} byte MSG to a {} member room".format(len(data[0]), args.members))
+    for name, total in totals.items():
+        print("{:>8}: {:>10} bytes total {:>8.1f} bytes/recipient".format(
+            name, total, total / args.members))
+
+
+def list_response(room, items):
+    """a List response built the way IRCHandler._handle_list builds it"""
+    packet = protocol.List(room, status=Status.OK)
+    packet.response = " ".join(items)
+    packet.length = len(items)
+    return packet
+
+
+def stats_response():
+    """a Stats response as IRCHandler._handle_stats answers it, for a server that has just started"""
+    return protocol.Stats(metrics.Metrics().report({}, {}), status=Status.OK)
+
+
+# realistic packets for each opcode, as a client sends them or the server answers
+ROOMS_100 = ["room{}".format(i) for i in range(100)]
+CODEC_CASES = {
+    "connect": lambda: protocol.Connect("lisa", {"mode": protocol.SESSION, "wire": "2"}),
+    "disconnect": lambda: protocol.Disconnect("lisa", status=Status.OK),
+    "msg": lambda: protocol.Message("lisa", "how is everyone doing today", "room", status=Status.OK),
+    "msg_4k": lambda: protocol.Message("lisa", ("lorem ipsum " * 342)[:4096].strip(), "room", status=Status.OK),
+    "private_msg": lambda: protocol.PrivateMessage("lisa", " ".join(["are you around later"] * 4), "bob",
+                                                   status=Status.OK),
+    "broadcast_100": lambda: protocol.Broadcast("lisa", " ".join(["server maintenance at noon"] * 4), ROOMS_100,
+                                                status=Status.OK),
+    "list": lambda: list_response(None, ROOMS_100),
+    "list_room": lambda: list_response("room", ["lisa", "bob", "carol", "dave"]),
+    "join": lambda: protocol.Join("lisa", "room", status=Status.OK),
+    "leave": lambda: protocol.Leave("lisa", "room", status=Status.OK),
+    "create": lambda: protocol.Create("room", status=Status.ERR,
+                                      err="room already exists, use /join to join the room."),
+    "destroy": lambda: protocol.Destroy("room", status=Status.OK),
+    "stats": stats_response,
+    "ping": lambda: protocol.Ping("lisa"),
+    "pong": lambda: protocol.Pong("lisa", status=Status.OK),
+}
+
+WIRES = {"text": protocol.WIRE_TEXT, "binary": protocol.WIRE_BINARY}
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+
+def reference():
+    """a fixed pure Python workload each case is measured against"""
+    return " ".join(REFERENCE_WORDS).split(" ")
+
+
+REFERENCE_WORDS = ["word{}".format(i) for i in range(64)]
+
+
+def relative_throughput(fn, rounds=21, seconds=0.01):
+    """
+    time fn and the reference workload back to back, round after round, so both
+    see the same machine: frequency scaling and other processes slow them
+    alike and cancel out of each round's ratio
+
+    :param rounds: how many ratios to take the median of
+    :param seconds: about how long each timing runs
+    :return: (calls per second of fn, its median speed relative to the reference's)
+    """
+    timers = [timeit.Timer(fn), timeit.Timer(reference)]
+    numbers = [max(1, int(seconds / (timer.timeit(10) / 10))) for timer in timers]
+    rates = []
+    ratios = []
+    for _ in range(rounds):
+        fn_time, reference_time = [timer.timeit(number) / number for timer, number in zip(timers, numbers)]
+        rates.append(1 / fn_time)
+        ratios.append(reference_time / fn_time)
+    return statistics.median(rates), statistics.median(ratios)
+
+
+def bench_codec(args):
+    """
+    encode and decode throughput of every opcode in both wire formats,
+    optionally saved as, or checked against, the stored baseline. Results are
+    kept relative to the reference workload, a baseline then holds on any
+    speed of the machine that saved it
+    """
+    ops = {}
+    results = {}
+    for name, make in sorted(CODEC_CASES.items()):
+        packet = make()
+        for wire_name, wire in WIRES.items():
+            data = protocol.encode(packet, wire)
+            case = "{}.{}".format(name, wire_name)
+            ops[case + ".encode"], results[case + ".encode"] = relative_throughput(
+                lambda: protocol.encode(packet, wire))
+            ops[case + ".decode"], results[case + ".decode"] = relative_throughput(
+                lambda: protocol.decode(data))
+
+    baselines = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baselines = json.load(f)
+    baseline = baselines.get("codec", {})
+
+    regressions = []
+    print("{:<36} {:>12} {:>10} {:>10} {:>8}".format("case", "ops/s", "relative", "baseline", "change"))
+    for case, relative in sorted(results.items()):
+        base = baseline.get(case)
+        change = "" if base is None else "{:+.0%}".format(relative / base - 1)
+        print("{:<36} {:>12.0f} {:>10.4f} {:>10} {:>8}".format(
+            case, ops[case], relative, "" if base is None else "{:.4f}".format(base), change))
+        if base is not None and relative < base * (1 - args.tolerance):
+            regressions.append(case)
+
+    if args.save:
+        baselines["codec"] = results
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print("baseline saved to {}".format(BASELINE_FILE))
+    if args.check:
+        if not baseline:
+            sys.exit("no codec baseline in {}, run with --save first".format(BASELINE_FILE))
+        if regressions:
+            sys.exit("regressed more than {:.0%}: {}".format(args.tolerance, " ".join(regressions)))
+        print("no regressions beyond {:.0%}".format(args.tolerance))
+
+
+def bench_snapshot(args):
+    """
+    save and restore of a snapshot of args.users dial-back users,
+    each in three of args.users // 100 rooms
+    """
+    rooms = ["room{}".format(i) for i in range(max(args.users // 100, 3))]
+    users = [("user{}".format(i), "127.0.0.1", 1024 + i % 60000, protocol.WIRE_TEXT,
+              ("user{}".format(i),) + tuple(random.sample(rooms, 3))) for i in range(args.users)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        server.SNAPSHOT_PATH = os.path.join(directory, "snapshot")
+        snapshot.save(server.SNAPSHOT_PATH, rooms, users)
+        size = os.path.getsize(server.SNAPSHOT_PATH)
+
+        started = time.perf_counter()
+        server.restore_snapshot()
+        restored = time.perf_counter() - started
+
+        started = time.perf_counter()
+        server.save_snapshot(*server.snapshot_state())
+        saved = time.perf_counter() - started
+
+    print("snapshot of {} users in {} rooms, {} bytes".format(len(server.USERS), len(server.ROOMS), size))
+    print("{:>8}: {:.3f}s".format("restore", restored))
+    print("{:>8}: {:.3f}s".format("save", saved))
+
+
+class LegacyOutbox(object):
+    """Outbox as it was before __slots__, holding a deque even while idle"""
+
+    def __init__(self, size, policy):
+        self.size = size
+        self.policy = policy
+        self.items = collections.deque()
+        self.lock = threading.Lock()
+        self.draining = False
+        self.closed = False
+
+
+class LegacyUser(object):
+    """User as it was before __slots__ and interning, its room list seeded with its nick"""
+
+    def __init__(self, nick, address):
+        self.nick = nick
+        self.address = address
+        self.rooms = [nick]
+        self.session = None
+        self.wire = protocol.WIRE_TEXT
+        self.outbox = None
+        self.worker = None
+
+    def join_room(self, room):
+        if room not in self.rooms:
+            self.rooms.append(room)
+
+
+def connect_users(n, rooms_per_user, rooms, make_user, make_outbox, make_room):
+    """
+    build the state n idle users leave on the server, the way its handlers build it.
+    Names arrive in decoded packets, so each one starts out as a new string.
+
+    :return: (USERS, ROOMS, ADDRESSES)
+    """
+    def decoded(name):
+        return name.encode().decode()
+
+    users, room_members, addresses = {}, {}, {}
+    for room in rooms:
+        room_members[make_room(decoded(room))] = set()
+    for i in range(n):
+        user = make_user(decoded("user{}".format(i)), ("127.0.0.1", 1024 + i % 60000))
+        user.outbox = make_outbox(server.OUTBOX_SIZE, server.OUTBOX_POLICY)
+        users[user.nick] = user
+        addresses[user.address] = user.nick
+        for j in range(rooms_per_user):
+            room = decoded(rooms[(i + j * 7) % len(rooms)])
+            user.join_room(room)
+            room_members[room].add(user.nick)
+    return users, room_members, addresses
+
+
+def bench_memory(args):
+    """
+    bytes per connected idle user, each in args.rooms_per_user rooms, before
+    and after __slots__, interned names and an outbox that is empty while idle
+    """
+    rooms = ["room{}".format(i) for i in range(max(args.users // 100, args.rooms_per_user))]
+    builds = {
+        "before": (LegacyUser, LegacyOutbox, lambda room: room),
+        "after": (server.User, server.Outbox, sys.intern),
+    }
+
+    print("{} idle users in {} of {} rooms each".format(args.users, args.rooms_per_user, len(rooms)))
+    tracemalloc.start()
+    for name, (make_user, make_outbox, make_room) in builds.items():
+        before = tracemalloc.get_traced_memory()[0]
+        built = connect_users(args.users, args.rooms_per_user, rooms, make_user, make_outbox, make_room)
+        total = tracemalloc.get_traced_memory()[0] - before
+        del built
+        print("{:>8}: {:>12} bytes total {:>8.1f} bytes/user".format(name, total, total / args.users))
+    tracemalloc.stop()
+
+
+# what room chatter is made of, for the compression benchmark
+WORDS = ("the a to and of is in it you that for on are with be this have at but not what "
+         "was so can just do if get we know like my all me about now lol ok yes no think "
+         "time good see one there out up they going when deploy build test server room").split()
+
+
+def room_traffic(members, count):
+    """:return: count room messages from random members of a room of members users"""
+    nicks = ["user{}".format(i) for i in range(members)]
+    room = "room{}".format(members)
+    return [protocol.Message(random.choice(nicks), " ".join(random.choices(WORDS, k=random.randint(2, 16))), room,
+                             status=Status.OK) for _ in range(count)]
+
+
+def best_time(fn, repeat=3):
+    """:return: the fastest of repeat runs of fn, in seconds"""
+    return min(timeit.Timer(fn).repeat(repeat=repeat, number=1))
+
+
+def bench_compression(args):
+    """
+    bytes on the wire and CPU per room message with and without session
+    compression, for rooms of each of args.room_sizes members. Every member's
+    session compresses its own copy, so the server's cost per message sent
+    into a room is the per copy cost times the room size.
+    """
+    random.seed(0)
+    print("{:>6} {:>6} {:>5} {:>9} {:>9} {:>6} {:>12} {:>15} {:>12}".format(
+        "room", "wire", "level", "plain B", "zlib B", "ratio", "deflate us", "server us/msg", "inflate us"))
+    for members in args.room_sizes:
+        packets = room_traffic(members, args.messages)
+        for wire_name, wire in WIRES.items():
+            frames = [protocol.encode(packet, wire) for packet in packets]
+            plain = sum(len(frame) for frame in frames)
+            for level in (1, 6):
+                def deflate():
+                    deflater = protocol.Deflater(level)
+                    return [deflater.compress(frame) for frame in frames]
+
+                def inflate():
+                    decoder = protocol.StreamDecoder()
+                    decoder.inflate()
+                    for data in compressed:
+                        for _ in decoder.feed(data):
+                            pass
+
+                compressed = deflate()
+                size = sum(len(data) for data in compressed)
+                deflate_us = best_time(deflate) / len(frames) * 1e6
+                inflate_us = best_time(inflate) / len(frames) * 1e6
+                print("{:>6} {:>6} {:>5} {:>9.1f} {:>9.1f} {:>6.2f} {:>12.2f} {:>15.1f} {:>12.2f}".format(
+                    members, wire_name, level, plain / len(frames), size / len(frames), plain / size,
+                    deflate_us, deflate_us * members, inflate_us))
+
+
+def legacy_find_users_broadcast(rooms):
+    """find_users_broadcast() as it was, deduplicating recipients in a list"""
+    users = []
+    for room in rooms:
+        for nick in server.STATE.members(room):
+            user = server.USERS.get(nick)
+            if user is not None and room in user.rooms and user not in users:
+                users.append(user)
+    return users
+
+
+# rooms the broadcast benchmark resolves the old way
+LEGACY_BROADCAST_ROOMS = 20
+
+
+def bench_broadcast(args):
+    """
+    resolving the recipients of a BROADCAST_MSG to args.broadcast_rooms rooms
+    on a server of args.broadcast_users users, each in args.broadcast_rooms_per_user
+    random rooms, after set union, and encoding a copy for each group of
+    recipients. The list the recipients were deduplicated in before takes
+    minutes for all the rooms, so before and after are compared on
+    LEGACY_BROADCAST_ROOMS of them.
+    """
+    random.seed(0)
+    rooms = ["room{}".format(i) for i in range(args.broadcast_rooms)]
+    for room in rooms:
+        server.STATE.create_room(room)
+    for i in range(args.broadcast_users):
+        user = server.User("user{}".format(i), ("127.0.0.1", 1024 + i))
+        server.STATE.add_user(user)
+        for room in random.sample(rooms, min(args.broadcast_rooms_per_user, len(rooms))):
+            server.STATE.join(user, room)
+    print("BROADCAST_MSG to {} rooms of {} users, each in {} rooms".format(
+        len(rooms), args.broadcast_users, args.broadcast_rooms_per_user))
+
+    some = rooms[:LEGACY_BROADCAST_ROOMS]
+    for name, find, targets in (("before", legacy_find_users_broadcast, some),
+                                ("after", server.find_users_broadcast, some),
+                                ("after", server.find_users_broadcast, rooms)):
+        started = time.perf_counter()
+        found = find(targets)
+        elapsed = time.perf_counter() - started
+        if name == "before":
+            print("{:>8}: {:>4} rooms {:>8.3f}s {:>6} recipients".format(name, len(targets), elapsed, len(found)))
+            continue
+
+        started = time.perf_counter()
+        for matched in found:
+            protocol.Broadcast("lisa", "hello rooms", matched, status=Status.OK).encode()
+        encoding = time.perf_counter() - started
+        print("{:>8}: {:>4} rooms {:>8.3f}s {:>6} recipients in {} groups, {:.3f}s to encode a copy for each".format(
+            name, len(targets), elapsed, sum(len(users) for users in found.values()), len(found), encoding))
+
+
+def hammer(store, nicks, rooms, operations, seed):
+    """
+    the handlers' traffic on a StateStore: mostly fan-out reading room members,
+    then joins and leaves, with users connecting and dropping and rooms being
+    created and destroyed all along
+    """
+    rnd = random.Random(seed)
+    for _ in range(operations):
+        roll = rnd.random()
+        nick = rnd.choice(nicks)
+        room = rnd.choice(rooms)
+        user = store.users.get(nick)
+        if roll < 0.6:
+            for member in store.members(room):
+                store.users.get(member)
+        elif roll < 0.8:
+            if user is not None:
+                store.join(user, room)
+        elif roll < 0.9:
+            if user is not None:
+                store.leave(user, room)
+        elif roll < 0.995:
+            if user is None:
+                store.add_user(server.User(nick, ("127.0.0.1", 1024 + nicks.index(nick))))
+            else:
+                store.drop_user(nick)
+        elif not store.destroy_room(room):
+            store.create_room(room)
+
+
+# how many times the stress benchmark stops its threads to check the store
+STRESS_ROUNDS = 100
+
+
+def bench_stress(args):
+    """
+    hammer one StateStore from 1 and then args.threads threads, args.operations
+    operations each over 32 users and 8 rooms, checking it is consistent every
+    STRESS_ROUNDS-th of the way. Threads are switched every few microseconds to
+    interleave them as much as possible.
+    """
+    nicks = ["user{}".format(i) for i in range(32)]
+    rooms = ["room{}".format(i) for i in range(8)]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    failed = False
+    try:
+        for threads in sorted({1, args.threads}):
+            store = state.StateStore()
+            for room in rooms:
+                store.create_room(room)
+            elapsed = 0.0
+            problems = []
+            for i in range(STRESS_ROUNDS):
+                workers = [threading.Thread(target=hammer, args=(store, nicks, rooms, args.operations // STRESS_ROUNDS,
+                                                                 i * threads + seed))
+                           for seed in range(threads)]
+                started = time.perf_counter()
+                for worker in workers:
+                    worker.start()
+                for worker in workers:
+                    worker.join()
+                elapsed += time.perf_counter() - started
+                problems += store.check()
+            print("{:>3} threads: {:>9.0f} ops/s, {} users, {} rooms, {} problems".format(
+                threads, threads * args.operations / elapsed, len(store.users), len(store.rooms), len(problems)))
+            for problem in problems[:10]:
+                print("    " + problem)
+            failed = failed or bool(problems)
+    finally:
+        sys.setswitchinterval(interval)
+    if failed:
+        sys.exit("the state store was left inconsistent")
+
+
+BENCHMARKS = {
+    "fanout": bench_fanout,
+    "codec": bench_codec,
+    "snapshot": bench_snapshot,
+    "memory": bench_memory,
+    "compression": bench_compression,
+    "stress": bench_stress,
+    "broadcast": bench_broadcast,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="IRC server benchmarks")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--members", type=int, default=1000,
+                        help="room size for fan-out benchmarks")
+    parser.add_argument("--users", type=int, default=100000,
+                        help="users in the snapshot and memory benchmarks")
+    parser.add_argument("--rooms-per-user", type=int, default=20,
+                        help="rooms each user is in for the memory benchmark")
+    parser.add_argument("--room-sizes", type=lambda s: [int(n) for n in s.split(",")], default=[10, 100, 1000],
+                        help="comma separated room sizes for the compression benchmark")
+    parser.add_argument("--messages", type=int, default=2000,
+                        help="room messages per case in the compression benchmark")
+    parser.add_argument("--broadcast-users", type=int, default=50000,
+                        help="users on the server in the broadcast benchmark")
+    parser.add_argument("--broadcast-rooms", type=int, default=200,
+                        help="rooms named in the broadcast benchmark's BROADCAST_MSG")
+    parser.add_argument("--broadcast-rooms-per-user", type=int, default=3,
+                        help="rooms each user is in for the broadcast benchmark")
+    parser.add_argument("--threads", type=int, default=8,
+                        help="threads hammering the state store in the stress benchmark")
+    parser.add_argument("--operations", type=int, default=100000,
+                        help="operations each thread makes in the stress benchmark")
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--check", action="store_true",
+                        help="fail if a result regressed past --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="allowed slowdown against the baseline, as a fraction")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
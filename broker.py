@@ -0,0 +1,113 @@
+"""
+Broker module - links the worker processes of a multi-process server.
+
+Every worker keeps its own copy of USERS and ROOMS. A worker publishes each
+state change it makes, and each delivery for users connected to another
+worker, to the broker process over a Unix socket. The broker relays state
+changes to every other worker and deliveries to the worker the recipients
+are connected to. Events from one worker are relayed in the order it sent
+them, so every copy applies a worker's changes in the same order.
+"""
+
+import queue
+import signal
+import threading
+from multiprocessing.connection import Client, Listener, wait
+
+# events are tuples, the first item is their kind
+CONNECT = "connect"
+DROP = "drop"
+CREATE = "create"
+DESTROY = "destroy"
+JOIN = "join"
+LEAVE = "leave"
+# (DELIVER, worker, nicks, {wire: encoded packet}, room) goes to worker only. room is
+# set for a room message, which the worker keeps in the room's history as well
+DELIVER = "deliver"
+# (HEARD, worker, nick) a user of worker's sent a packet to another worker, goes to worker only
+HEARD = "heard"
+# (GONE, worker) is sent by the broker when a worker's link closes
+GONE = "gone"
+
+
+def listen(path):
+    """
+    :param path: where to put the Unix socket, in a directory only this user can reach
+    :return: a Listener the broker process will accept worker links on
+    """
+    return Listener(path, family="AF_UNIX")
+
+
+def run(listener, workers):
+    """
+    accept a link from each of the workers, then relay their events until
+    every link has closed. This is the broker process's main loop.
+
+    :param listener: the Listener from listen()
+    :param workers: how many workers will connect
+    """
+    # a Ctrl-C reaches the whole process group, the server stops the broker itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    links = {}
+    while len(links) < workers:
+        conn = listener.accept()
+        links[conn.recv()] = conn
+    # the listener is left to the server process, closing it here would remove the socket file
+    workers_of = {conn: worker for worker, conn in links.items()}
+
+    while links:
+        for conn in wait(list(links.values())):
+            worker = workers_of[conn]
+            try:
+                event = conn.recv()
+            except (EOFError, OSError):
+                del links[worker]
+                event = (GONE, worker)
+
+            if event[0] in (DELIVER, HEARD):
+                targets = [links[event[1]]] if event[1] in links else []
+            else:
+                targets = [link for other, link in links.items() if other != worker]
+            for target in targets:
+                try:
+                    target.send(event)
+                except OSError:
+                    pass  # its link is dropped once the broker reads its EOF
+
+
+class BrokerLink(object):
+    """
+    A worker's link to the broker. send() only queues the event, a sender
+    thread writes it, so publishing never blocks a handler. Events relayed
+    from the other workers are passed to on_event on a reader thread.
+    """
+
+    def __init__(self, path, worker, on_event):
+        self.worker = worker
+        self.on_event = on_event
+        self.outgoing = queue.SimpleQueue()
+        self.conn = Client(path, family="AF_UNIX")
+        self.conn.send(worker)
+
+        threading.Thread(target=self._send_loop, daemon=True).start()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def send(self, event):
+        """queue an event for the broker"""
+        self.outgoing.put(event)
+
+    def _send_loop(self):
+        while True:
+            try:
+                self.conn.send(self.outgoing.get())
+            except OSError:
+                return
+
+    def _read_loop(self):
+        while True:
+            try:
+                event = self.conn.recv()
+            except (EOFError, OSError):
+                return
+            self.on_event(event)
@@ -1,18 +1,25 @@
 import socketserver
 import logging
+import logsink
 import socket
 import protocol
 import queue
 import threading
 import os
+import argparse
+import collections
+import time
 from protocol import Status
 from protocol import Opcode
 
 target_host = '0.0.0.0'
 target_port = 9999
 
-# set up logging
-logging.basicConfig(format='%(asctime)s %(message)s')
+# bytes read per recv on a compressed session, and the largest packet it accepts
+RECV_SIZE = 64 * 1024
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+# set up logging, records are written by logsink's writer thread once configured
 logger = logging.getLogger("server-log")
 logger.setLevel(logging.INFO)
 
@@ -21,53 +28,252 @@ USERNAME = "player1"
 ROOMS = []
 msg_q = queue.Queue()
 
+# the connection to the server when running in session mode, None in legacy mode
+SESSION = None
+
+
+def deliver(packet):
+    """
+    handle a packet the server delivered, either through the legacy
+    listener or pushed over the session
+
+    :param packet: the delivered packet
+    """
+    # stick packet on msg_q
+    if packet.opcode == Opcode.PRIVATE_MSG:
+        msg_q.put("*" + packet.username + ": " + packet.message)
+    elif packet.opcode == Opcode.BROADCAST_MSG:
+        msg_q.put("BROADCAST|" + packet.username + ": " + packet.message)
+    elif packet.opcode == Opcode.MSG:
+        msg_q.put(packet.username + "(" + packet.room + ")" + ": " + packet.message)
+    elif packet.opcode == Opcode.DISCONNECT:
+        logger.info("%s", packet.err)
+        logsink.shutdown()
+        os._exit(1)  # Handle Server Disconnect
+
 
 class IRCClient(socketserver.StreamRequestHandler):
+    """
+    listener the server dials back to in legacy mode, the server keeps
+    its connection open and sends one packet after another over it
+    """
+
     def handle(self):
         try:
-            # read data from socket
-            self.data = self.rfile.readline().strip()
-            logger.debug(self.data)
-            # decode packet
-            packet = protocol.decode(self.data)
-            logger.debug("{} sent packet {}".format(self.client_address[0], packet.encode()))
-            # stick packet on msg_q
-            if packet.opcode == Opcode.PRIVATE_MSG:
-                msg_q.put("*" + packet.username + ": " + packet.message)
-            elif packet.opcode == Opcode.BROADCAST_MSG:
-                msg_q.put("BROADCAST|" + packet.username + ": " + packet.message)
-            elif packet.opcode == Opcode.MSG:
-                msg_q.put(packet.username + "(" + packet.room + ")" + ": " + packet.message)
-            elif packet.opcode == Opcode.DISCONNECT:
-                logger.info("{}".format(packet.err))
-                os._exit(1)  # Handle Server Disconnect
+            while True:
+                # read data from socket until the server closes the connection
+                self.data = protocol.read_frame(self.rfile)
+                if not self.data:
+                    return
+                logger.debug("%s", self.data)
+                # decode packet
+                packet = protocol.decode(self.data)
+                logger.debug("%s sent packet %r", self.client_address[0], packet)
+                deliver(packet)
         except SystemError:
+            logsink.shutdown()
             os._exit(1)
+        except socket.error as e:
+            logger.debug("listener connection error %s", e)
+
+
+class Pending(object):
+    """a request written to the session that is waiting for its response"""
+
+    def __init__(self, opcode):
+        self.opcode = opcode
+        self.response = None
+        self.done = threading.Event()
+
+    def set(self, response):
+        self.response = response
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        return self.response
+
+
+class Session(object):
+    """
+    One long-lived connection to the server. Commands are written to it and
+    answered in order, and the server pushes MSG, PRIVATE_MSG, BROADCAST_MSG
+    and DISCONNECT packets over the same connection.
+    """
+
+    def __init__(self, sock, rfile=None, wire=protocol.WIRE_TEXT, compress=False):
+        self.sock = sock
+        self.rfile = sock.makefile('rb') if rfile is None else rfile
+        self.wire = wire
+        # a compressed session is a deflate stream both ways after the Connect response
+        self.deflater = protocol.Deflater() if compress else None
+        self.lock = threading.Lock()
+        self.pending = collections.deque()
+        self.closing = False
+
+    def start(self):
+        """start reading responses and pushes in the background"""
+        reader = threading.Thread(target=self._read_loop)
+        reader.daemon = True
+        reader.start()
+
+    def submit(self, packet):
+        """
+        write a packet without waiting for its response
+
+        :param packet: the packet to send
+        :return: a Pending for the response
+        """
+        return self.submit_many([packet])[0]
+
+    def submit_many(self, packets):
+        """
+        pipeline packets in one write without waiting for any response
+
+        :param packets: list of packets to send
+        :return: a list of Pending, in the same order
+        """
+        pendings = [Pending(protocol.response_opcode(packet.opcode)) for packet in packets]
+        data = b"".join(protocol.encode(packet, self.wire) for packet in packets)
+        with self.lock:
+            if self.deflater is not None:
+                data = self.deflater.compress(data)
+            self.pending.extend(pendings)
+            self.sock.sendall(data)
+        return pendings
+
+    def request(self, packet):
+        """write a packet and wait for its response"""
+        return self.submit(packet).wait()
+
+    def _frames(self):
+        """yield each packet's bytes the server sends, until it hangs up"""
+        if self.deflater is None:
+            while True:
+                frame = protocol.read_frame(self.rfile)
+                if not frame:
+                    return
+                yield frame
+
+        # read1 hands back what rfile buffered along with the Connect response first
+        decoder = protocol.StreamDecoder(MAX_FRAME_SIZE)
+        decoder.inflate()
+        while True:
+            data = self.rfile.read1(RECV_SIZE)
+            if not data:
+                return
+            yield from decoder.feed(data)
+
+    def _read_loop(self):
+        for frame in self._frames():
+            packet = protocol.decode(frame)
+            logger.debug("server sent packet %r", packet)
+            if self.pending and self._is_response(packet, self.pending[0]):
+                self.pending.popleft().set(packet)
+            else:
+                deliver(packet)
+        if not self.closing:
+            logger.info("lost connection to server")
+            logsink.shutdown()
+            os._exit(1)
+
+    @staticmethod
+    def _is_response(packet, pending):
+        """
+        responses come back in request order, anything else is a push. Our own
+        copy of a room message is indistinguishable from the response to it, but
+        the copy is always written first so taking either one is the same.
+        """
+        if packet.opcode != pending.opcode:
+            return False
+        if packet.opcode in (Opcode.MSG, Opcode.PRIVATE_MSG, Opcode.BROADCAST_MSG):
+            return packet.username == USERNAME
+        if packet.opcode == Opcode.DISCONNECT:
+            return packet.err != "server shutting down"
+        return True
 
 
 def send(packet):
+    res = send_many([packet])[0]
+    if res.status == protocol.Status.ERR:
+        print(res.err)
+    return res
+
+
+def send_many(packets):
+    """
+    send a batch of packets and wait for all of their responses. On a session the
+    batch is pipelined, so it costs about one round trip however long it is.
+
+    :param packets: list of packets to send
+    :return: list of responses, in request order
+    """
+    if SESSION is not None:
+        return [pending.wait() for pending in SESSION.submit_many(packets)]
+    return [send_once(packet) for packet in packets]
+
+
+def send_once(packet):
+    """
+    send a packet on a connection of its own and read the response (legacy mode)
+
+    :param packet: the packet to send
+    :return: the response
+    """
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((target_host, target_port))
     s.send(packet.encode())
-    for res in s.makefile('r'):
-        res = res.encode()
-        res = protocol.decode(res)
-        if res.status == protocol.Status.OK:
-            s.close()
-            return res
-        elif res.status == protocol.Status.ERR:
-            print(res.err)
-            s.close()
-            return res
+    frame = protocol.read_frame(s.makefile('rb'))
+    s.close()
+    if not frame:
+        raise ConnectionResetError("server closed the connection without a response")
+    return protocol.decode(frame)
 
 
 def bsend(packet):
+    if SESSION is not None:
+        SESSION.submit(packet)
+        return
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.connect((target_host, target_port))
     s.send(packet.encode())
     s.close()
 
 
+def heartbeat(interval):
+    """
+    PING the server every interval seconds so it knows we are still here,
+    runs on its own thread. A server that cannot be reached may be restarting
+    and restore us from its snapshot, so only a PONG refusing us stops the beat
+
+    :param interval: seconds between PINGs
+    """
+    while True:
+        time.sleep(interval)
+        try:
+            res = send_many([protocol.Ping(USERNAME)])[0]
+        except socket.error as e:
+            logger.info("could not ping the server: %s", e)
+            continue
+        if res.opcode == Opcode.PONG and res.status == protocol.Status.ERR:
+            logger.info("disconnected by the server: %s", res.err)
+            logsink.shutdown()
+            os._exit(1)
+
+
+def start_heartbeat(config):
+    """
+    start PINGing the server, three times within the idle time its Connect response gave
+
+    :param config: the Connect response's config
+    """
+    if "idle" not in config:
+        return
+    beat = threading.Thread(target=heartbeat, args=(float(config["idle"]) / 3,))
+    beat.daemon = True
+    beat.start()
+
+
 def display():
     while True:
         if msg_q.empty():
@@ -102,13 +308,11 @@ def _list(cmd):
             for r in res.response:
                 print(r)
         else:
-            logger.info(res.err)
+            logger.info("%s", res.err)
         return
 
     rooms = cmd.split(" ")
-    res = []
-    for room in rooms:
-        res.append(send_list(protocol.List(room)))
+    res = send_many([protocol.List(room) for room in rooms])
 
     for r in res:
         if r.status == Status.OK:
@@ -116,41 +320,60 @@ def _list(cmd):
             for user in r.response:
                 print(user)
         else:
-            logger.info(r.err)
+            logger.info("%s", r.err)
 
 
 def send_list(packet):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((target_host, target_port))
-    s.send(packet.encode())
-    for res in s.makefile('r'):
-        res = res.encode()
-        s.close()
-        return protocol.decode(res)
+    return send_many([packet])[0]
+
+
+def stats():
+    res = send(protocol.Stats())
+    if res.status == Status.OK:
+        for token in res.response:
+            print(token)
 
 
 def join(cmd):
-    rooms = cmd.split(" ")
-    for room in rooms:
-        send_join(room)
+    join_many(cmd.split(" "))
 
 
-def send_join(room):
-    res = send(protocol.Join(USERNAME, room))
-    if res.status == Status.OK:
-        ROOMS.append(room)
+def join_many(rooms):
+    """
+    join every room in one pipelined batch
+
+    :param rooms: list of room names
+    :return: list of Join responses
+    """
+    responses = send_many([protocol.Join(USERNAME, room) for room in rooms])
+    for room, res in zip(rooms, responses):
+        if res.status == Status.OK:
+            if room not in ROOMS:
+                ROOMS.append(room)
+        else:
+            print(res.err)
+    return responses
 
 
 def leave(cmd):
-    rooms = cmd.split(" ")
-    for room in rooms:
-        send_leave(room)
+    leave_many(cmd.split(" "))
 
 
-def send_leave(room):
-    res = send(protocol.Leave(USERNAME, room))
-    if res.status == Status.OK and res.room in ROOMS:
-        ROOMS.remove(room)
+def leave_many(rooms):
+    """
+    leave every room in one pipelined batch
+
+    :param rooms: list of room names
+    :return: list of Leave responses
+    """
+    responses = send_many([protocol.Leave(USERNAME, room) for room in rooms])
+    for room, res in zip(rooms, responses):
+        if res.status == Status.OK:
+            if room in ROOMS:
+                ROOMS.remove(room)
+        else:
+            print(res.err)
+    return responses
 
 
 def broadcast(cmd):
@@ -164,28 +387,47 @@ def send_broadcast(msg, rooms):
 
 
 def create_room(cmd):
-    rooms = cmd.split(" ")
-    for room in rooms:
-        send_create(room)
+    create_many(cmd.split(" "))
 
 
-def send_create(room):
-    res = send(protocol.Create(room))
-    if res == Status.OK:
-        if send(protocol.Join(USERNAME, room)) == Status.OK:
-            ROOMS.append(room)
+def create_many(rooms):
+    """
+    create every room in one pipelined batch, then join the ones created in a second
+
+    :param rooms: list of room names
+    :return: list of Create responses
+    """
+    responses = send_many([protocol.Create(room) for room in rooms])
+    created = []
+    for room, res in zip(rooms, responses):
+        if res.status == Status.OK:
+            created.append(room)
+        else:
+            print(res.err)
+    if created:
+        join_many(created)
+    return responses
 
 
 def destroy_room(cmd):
-    rooms = cmd.split(" ")
-    for room in rooms:
-        send_destroy(room)
+    destroy_many(cmd.split(" "))
 
 
-def send_destroy(room):
-    res = send(protocol.Destroy(room))
-    if res == Status.OK and res.room in ROOMS:
-        ROOMS.remove(room)
+def destroy_many(rooms):
+    """
+    destroy every room in one pipelined batch
+
+    :param rooms: list of room names
+    :return: list of Destroy responses
+    """
+    responses = send_many([protocol.Destroy(room) for room in rooms])
+    for room, res in zip(rooms, responses):
+        if res.status == Status.OK:
+            if room in ROOMS:
+                ROOMS.remove(room)
+        else:
+            print(res.err)
+    return responses
 
 
 def client():
@@ -202,8 +444,11 @@ def client():
         # /join room
         # /leave room
         # /broadcast room1 room2 room3 room4 room5
+        # /stats
 
         if cmd == "/quit":
+            if SESSION is not None:
+                SESSION.closing = True
             send(protocol.Disconnect(USERNAME))
             break
 
@@ -234,13 +479,36 @@ def client():
         elif cmd.find("/broadcast") != -1:
             broadcast(cmd.strip("/broadcast").strip(" "))
 
+        elif cmd.find("/stats") != -1:
+            stats()
+
         else:
             print(cmd, " not a valid command")
 
 
+def start_session(sock, rfile, wire, compress=False):
+    """
+    run the client over the connection that sent Connect
+
+    :param sock: the connected socket
+    :param rfile: the reader the Connect response was read from
+    :param wire: the wire format the server accepted
+    :param compress: True if the server agreed to compress the session
+    """
+    global SESSION
+    sock.settimeout(None)
+    SESSION = Session(sock, rfile, wire, compress)
+    SESSION.start()
+
+    client()
+
+
 def start_client(addr):
+    """run the client with a listener the server dials back to (legacy mode)"""
     client_server = socketserver.ThreadingTCPServer((addr[0], addr[1] + 100), IRCClient)
-    logger.debug("[*] client is now running on {} : {}".format(addr[0], addr[1]))
+    # the server's kept-alive connection must not keep the client from exiting
+    client_server.daemon_threads = True
+    logger.debug("[*] client is now running on %s : %s", addr[0], addr[1])
 
     client_thread = threading.Thread(target=client_server.serve_forever)
     client_thread.daemon = True
@@ -250,6 +518,21 @@ def start_client(addr):
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="IRC client")
+    parser.add_argument("--legacy", action="store_true",
+                        help="have the server dial back to a local listener "
+                             "instead of keeping one session connection")
+    parser.add_argument("--wire", type=int, default=protocol.WIRE_TEXT,
+                        choices=[protocol.WIRE_TEXT, protocol.WIRE_BINARY],
+                        help="1: text packets, 2: binary framing")
+    parser.add_argument("--compress", action="store_true",
+                        help="ask for the session to be zlib compressed, "
+                             "saves bandwidth on busy rooms for some CPU")
+    parser.add_argument("--log-level", choices=logsink.LEVEL_NAMES, default="INFO",
+                        help="initial log level, SIGUSR1/SIGUSR2 step it down/up while running")
+    parser.add_argument("--log-format", choices=logsink.FORMATS, default=logsink.PLAIN)
+    args = parser.parse_args()
+    logsink.configure(logger, args.log_level, args.log_format)
     try:
         # setup initial connection
 
@@ -262,16 +545,25 @@ if __name__ == '__main__':
         # get address to be used for later
         address = s.getsockname()
 
-        s.send(protocol.Connect(USERNAME, {}).encode())
+        mode = protocol.DIAL_BACK if args.legacy else protocol.SESSION
+        config = {"mode": mode, "wire": args.wire}
+        if args.compress and not args.legacy:
+            config["compress"] = protocol.COMPRESS_ZLIB
+        s.send(protocol.Connect(USERNAME, config).encode())
 
         # if response is ok, start client's server, else print error
-        for response in s.makefile('r'):
-            response = response.encode()
-            if protocol.decode(response).status == protocol.Status.OK:
+        rfile = s.makefile('rb')
+        response = protocol.decode(protocol.read_frame(rfile))
+        if response.status == protocol.Status.OK:
+            start_heartbeat(response.config)
+            if args.legacy:
                 s.close()
                 start_client(address)
-            elif protocol.decode(response).status == protocol.Status.ERR:
-                print(protocol.decode(response).err)
+            else:
+                start_session(s, rfile, int(response.config.get("wire", protocol.WIRE_TEXT)),
+                              response.config.get("compress") == protocol.COMPRESS_ZLIB)
+        elif response.status == protocol.Status.ERR:
+            print(response.err)
         s.close()
     except socket.error as serr:
         if serr.errno != 111:
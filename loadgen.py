@@ -0,0 +1,350 @@
+"""
+Load generator and end-to-end latency benchmark.
+
+Starts server.py on loopback (or targets a running one with --no-server),
+connects N simulated users spread across M rooms and has them send a mix of
+MSG, PRIVATE_MSG, BROADCAST_MSG and JOIN packets for a while. Every message
+carries its send time, so each recipient records how long the message took
+to arrive, on its session or on its dial-back listener. Results are written
+as JSON so runs against different server versions can be compared.
+
+    python loadgen.py --users 200 --rooms 20 --duration 10 --output run.json
+
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import protocol
+from protocol import Opcode
+from protocol import Status
+
+# packets recipients should time, the text is the tag then the send time in ns
+TAG = "lg"
+
+
+class Stats(object):
+    """counters and latency samples shared by every simulated user"""
+
+    def __init__(self):
+        self.sent = {}
+        self.errors = 0
+        self.rate_limited = 0
+        self.latencies = []
+
+    def record_send(self, opcode, response):
+        """:return: seconds the server asked to wait before sending again, 0 if none"""
+        self.sent[opcode.name] = self.sent.get(opcode.name, 0) + 1
+        if response is None or response.status != Status.OK:
+            wait = protocol.retry_after(response.err) if response is not None else None
+            if wait is not None:
+                self.rate_limited += 1
+                return wait
+            self.errors += 1
+        return 0
+
+    def record_delivery(self, packet, since=0):
+        """
+        :param since: ignore messages sent before this time, the room history replayed on JOIN
+        """
+        words = packet.message.split(" ")
+        if len(words) == 2 and words[0] == TAG and int(words[1]) >= since:
+            self.latencies.append(time.perf_counter_ns() - int(words[1]))
+
+
+class SimUser(object):
+    """
+    A simulated user. In session mode commands and deliveries share one
+    connection, in dial-back mode every command is its own connection and
+    deliveries arrive on a listener at the Connect port + 100.
+    """
+
+    def __init__(self, nick, args, stats):
+        self.nick = nick
+        self.args = args
+        self.stats = stats
+        self.rooms = []
+        # room -> when this user joined it
+        self.joined = {}
+        self.pending = []
+        self.reader = None
+        self.writer = None
+        self.deflater = None
+        self.listener = None
+
+    async def connect(self):
+        config = {"mode": self.args.mode, "wire": self.args.wire}
+        if self.args.mode == protocol.SESSION:
+            if self.args.compress:
+                config["compress"] = protocol.COMPRESS_ZLIB
+            self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+            asyncio.ensure_future(self._read_loop(self.reader))
+            response = await self.request(protocol.Connect(self.nick, config))
+            if response is not None and response.config.get("compress") == protocol.COMPRESS_ZLIB:
+                self.deflater = protocol.Deflater()
+            return response
+
+        # the server dials back to port + 100, so pick a free listener port first
+        while True:
+            self.listener = await asyncio.start_server(self._on_delivery, "127.0.0.1", 0)
+            port = self.listener.sockets[0].getsockname()[1] - 100
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                sock.bind(("127.0.0.1", port))
+                break
+            except OSError:
+                sock.close()
+                self.listener.close()
+        sock.setblocking(False)
+        await asyncio.get_running_loop().sock_connect(sock, (self.args.host, self.args.port))
+        reader, writer = await asyncio.open_connection(sock=sock)
+        writer.write(protocol.Connect(self.nick, config).encode())
+        response = protocol.decode(await reader.readline())
+        writer.close()
+        return response
+
+    async def request(self, packet):
+        """send a packet and wait for its response"""
+        if self.writer is None:
+            reader, writer = await asyncio.open_connection(self.args.host, self.args.port)
+            writer.write(protocol.encode(packet, self.args.wire))
+            decoder = protocol.StreamDecoder()
+            try:
+                while True:
+                    data = await reader.read(65536)
+                    if not data:
+                        return None
+                    for frame in decoder.feed(data):
+                        return protocol.decode(frame)
+            finally:
+                writer.close()
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((packet.opcode, future))
+        data = protocol.encode(packet, self.args.wire)
+        self.writer.write(data if self.deflater is None else self.deflater.compress(data))
+        return await future
+
+    async def _read_loop(self, reader):
+        decoder = protocol.StreamDecoder()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                for opcode, future in self.pending:
+                    future.set_result(None)
+                return
+            for frame in decoder.feed(data):
+                packet = protocol.decode(frame)
+                # what follows an accepted compression request is compressed
+                if packet.opcode == Opcode.CONNECT and packet.config.get("compress") == protocol.COMPRESS_ZLIB:
+                    decoder.inflate()
+                if self.pending and self._is_response(packet, self.pending[0][0]):
+                    self.pending.pop(0)[1].set_result(packet)
+                else:
+                    self._delivered(packet)
+
+    def _is_response(self, packet, opcode):
+        if packet.opcode != opcode:
+            return False
+        if opcode in (Opcode.MSG, Opcode.PRIVATE_MSG, Opcode.BROADCAST_MSG):
+            return packet.username == self.nick
+        return True
+
+    async def _on_delivery(self, reader, writer):
+        decoder = protocol.StreamDecoder()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            for frame in decoder.feed(data):
+                self._delivered(protocol.decode(frame))
+        writer.close()
+
+    def _delivered(self, packet):
+        # our own copies are not timed, they are indistinguishable from responses
+        if packet.opcode in (Opcode.MSG, Opcode.PRIVATE_MSG, Opcode.BROADCAST_MSG) \
+                and packet.username != self.nick:
+            since = self.joined.get(packet.room, 0) if packet.opcode == Opcode.MSG else 0
+            self.stats.record_delivery(packet, since)
+
+    async def run(self, users, rooms, deadline):
+        """send packets from the configured mix until the deadline"""
+        kinds, weights = zip(*self.args.mix.items())
+        while time.monotonic() < deadline:
+            kind = random.choices(kinds, weights)[0]
+            text = "{} {}".format(TAG, time.perf_counter_ns())
+            if kind == "msg":
+                packet = protocol.Message(self.nick, text, random.choice(self.rooms))
+            elif kind == "pm":
+                packet = protocol.PrivateMessage(self.nick, text, random.choice(users).nick)
+            elif kind == "broadcast":
+                k = min(len(self.rooms), self.args.broadcast_rooms)
+                packet = protocol.Broadcast(self.nick, text, random.sample(self.rooms, k))
+            else:
+                room = random.choice(rooms)
+                packet = protocol.Join(self.nick, room)
+                if room not in self.rooms:
+                    self.rooms.append(room)
+                    self.joined[room] = time.perf_counter_ns()
+            wait = self.stats.record_send(packet.opcode, await self.request(packet))
+            if wait or self.args.think:
+                await asyncio.sleep(max(wait, self.args.think))
+
+    async def close(self):
+        await self.request(protocol.Disconnect(self.nick))
+        if self.writer is not None:
+            self.writer.close()
+        if self.listener is not None:
+            self.listener.close()
+
+
+def percentile(samples, p):
+    """:return: the p-th percentile of sorted samples"""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+
+async def run(args):
+    stats = Stats()
+    rooms = ["room{}".format(i) for i in range(args.rooms)]
+    users = [SimUser("user{}".format(i), args, stats) for i in range(args.users)]
+
+    for user in users:
+        response = await user.connect()
+        if response is None or response.status != Status.OK:
+            raise RuntimeError("{} could not connect: {}".format(
+                user.nick, None if response is None else response.err))
+    for room in rooms:
+        await users[0].request(protocol.Create(room))
+    for user in users:
+        for room in random.sample(rooms, min(args.rooms_per_user, len(rooms))):
+            await user.request(protocol.Join(user.nick, room))
+            user.rooms.append(room)
+            user.joined[room] = time.perf_counter_ns()
+
+    # let the join notices drain so they are not timed
+    await asyncio.sleep(0.5)
+    stats.latencies = []
+    stats.sent = {}
+
+    start = time.monotonic()
+    await asyncio.gather(*[user.run(users, rooms, start + args.duration) for user in users])
+    elapsed = time.monotonic() - start
+    # wait for deliveries still in flight
+    await asyncio.sleep(args.drain)
+
+    for user in users:
+        await user.close()
+
+    latencies = sorted(stats.latencies)
+    sent = sum(stats.sent.values())
+    return {
+        "sent": stats.sent,
+        "errors": stats.errors,
+        "rate_limited": stats.rate_limited,
+        "deliveries": len(latencies),
+        "elapsed_s": elapsed,
+        "sent_per_s": sent / elapsed,
+        "deliveries_per_s": len(latencies) / elapsed,
+        "latency_ms": {
+            name: None if value is None else value / 1e6
+            for name, value in (("p50", percentile(latencies, 50)),
+                                ("p99", percentile(latencies, 99)),
+                                ("p999", percentile(latencies, 99.9)),
+                                ("max", latencies[-1] if latencies else None))
+        },
+    }
+
+
+def start_server(args):
+    """start server.py on loopback and wait until it accepts connections"""
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py"), "--host", args.host, "--port", str(args.port),
+               "--engine", args.engine] + args.server_arg
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection((args.host, args.port), timeout=0.1).close()
+            return proc
+        except socket.error:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def git_revision():
+    """:return: the commit of the checkout whose server.py is run, wherever we are run from"""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_mix(string):
+    """parse a mix like msg=70,pm=10,broadcast=10,join=10 into a dict of weights"""
+    mix = {}
+    for part in string.split(","):
+        kind, weight = part.split("=")
+        if kind not in ("msg", "pm", "broadcast", "join"):
+            raise argparse.ArgumentTypeError("unknown packet kind {}".format(kind))
+        mix[kind] = float(weight)
+    return mix
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="IRC server load generator")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rooms", type=int, default=10)
+    parser.add_argument("--rooms-per-user", type=int, default=3)
+    parser.add_argument("--broadcast-rooms", type=int, default=2,
+                        help="rooms named in each BROADCAST_MSG")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix("msg=70,pm=10,broadcast=10,join=10"),
+                        help="relative weights of msg, pm, broadcast and join")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of load")
+    parser.add_argument("--think", type=float, default=0.0,
+                        help="seconds each user waits between packets")
+    parser.add_argument("--drain", type=float, default=1.0,
+                        help="seconds to wait for in-flight deliveries")
+    parser.add_argument("--mode", choices=[protocol.SESSION, protocol.DIAL_BACK],
+                        default=protocol.SESSION)
+    parser.add_argument("--wire", type=int, choices=[protocol.WIRE_TEXT, protocol.WIRE_BINARY],
+                        default=protocol.WIRE_TEXT)
+    parser.add_argument("--compress", action="store_true", help="ask for compressed sessions")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9998)
+    parser.add_argument("--engine", default="threads", help="server.py --engine")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="extra argument passed to server.py, may be repeated")
+    parser.add_argument("--no-server", action="store_true",
+                        help="use the server already listening on --host/--port")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--output", default="loadgen.json", help="where to write the results")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    server = None if args.no_server else start_server(args)
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    config = dict(vars(args))
+    config.pop("output")
+    report = {"revision": git_revision(), "config": config, "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    latency = results["latency_ms"]
+    print("{sent_per_s:.0f} packets/s sent, {deliveries_per_s:.0f} deliveries/s".format(**results))
+    print("latency ms p50 {} p99 {} p999 {}".format(latency["p50"], latency["p99"], latency["p999"]))
+    print("results written to {}".format(args.output))
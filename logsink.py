@@ -0,0 +1,143 @@
+"""
+Logging setup shared by the server and the client.
+
+A configured logger hands its records to a queue and a QueueListener thread
+writes them out, so a slow terminal or log file never holds up a request
+handler. Log calls pass %-style arguments, which are only formatted for
+records that pass the level check.
+
+The level can be changed while running: SIGUSR1 makes the log one level
+more verbose and SIGUSR2 one level quieter, e.g.
+
+    kill -USR1 <pid>
+
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import signal
+
+PLAIN = "plain"
+STRUCTURED = "structured"
+FORMATS = (PLAIN, STRUCTURED)
+
+# the levels SIGUSR1 and SIGUSR2 step through
+LEVELS = [logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR, logging.CRITICAL]
+LEVEL_NAMES = [logging.getLevelName(level) for level in LEVELS]
+
+# the running QueueListeners, see shutdown()
+LISTENERS = []
+
+# logger -> log format, for every logger configure() set up, see after_fork()
+CONFIGURED = {}
+
+
+def quote(value):
+    """:return: value as a logfmt value, quoted when it has to be"""
+    value = str(value)
+    if not value or any(c in value for c in ' ="\n'):
+        return json.dumps(value)
+    return value
+
+
+class StructuredFormatter(logging.Formatter):
+    """
+    logfmt lines: time, level, logger, thread and message, then any fields the
+    call passed with extra=, so the log can be grepped and parsed alike
+    """
+
+    # attributes every LogRecord has, anything else was passed with extra=
+    STANDARD = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+    def format(self, record):
+        fields = ["time={}".format(quote(self.formatTime(record))),
+                  "level={}".format(record.levelname),
+                  "logger={}".format(quote(record.name)),
+                  "thread={}".format(quote(record.threadName)),
+                  "msg={}".format(quote(record.getMessage()))]
+        for key, value in record.__dict__.items():
+            if key not in self.STANDARD:
+                fields.append("{}={}".format(key, quote(value)))
+        return " ".join(fields)
+
+
+def configure(logger, level, log_format=PLAIN):
+    """
+    send a logger's records through a queue to a writer thread on stderr
+
+    :param logger: the Logger to configure
+    :param level: its level, a name such as "INFO" or a number
+    :param log_format: PLAIN or STRUCTURED
+    :return: the QueueListener writing the records, stopped by shutdown()
+    """
+    handler = logging.StreamHandler()
+    if log_format == STRUCTURED:
+        handler.setFormatter(StructuredFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, handler)
+    listener.start()
+    LISTENERS.append(listener)
+
+    for old in list(logger.handlers):
+        logger.removeHandler(old)
+    logger.addHandler(logging.handlers.QueueHandler(records))
+    logger.setLevel(level)
+    logger.propagate = False
+    install_level_signals(logger)
+    CONFIGURED[logger] = log_format
+    return listener
+
+
+def shutdown():
+    """
+    write out everything queued and stop the writer threads. Runs at exit,
+    call it before os._exit(), which skips exit handlers
+    """
+    while LISTENERS:
+        LISTENERS.pop().stop()
+
+
+atexit.register(shutdown)
+
+
+def after_fork():
+    """
+    give a forked child writer threads of its own, the parent's
+    are not running in it. Loggers keep their level and format.
+    """
+    del LISTENERS[:]
+    for logger, log_format in list(CONFIGURED.items()):
+        configure(logger, logger.level, log_format)
+
+
+def shift_level(logger, step):
+    """
+    move a logger's level through LEVELS
+
+    :param step: -1 for more verbose, 1 for quieter
+    :return: the new level
+    """
+    current = max([i for i, level in enumerate(LEVELS) if level <= logger.getEffectiveLevel()], default=0)
+    level = LEVELS[min(max(current + step, 0), len(LEVELS) - 1)]
+    logger.setLevel(level)
+    return level
+
+
+def install_level_signals(logger):
+    """make SIGUSR1 and SIGUSR2 step the logger's level down and up, where the platform has them"""
+    if not hasattr(signal, "SIGUSR1"):
+        return
+
+    def handler(signum, frame):
+        level = shift_level(logger, -1 if signum == signal.SIGUSR1 else 1)
+        # logged at WARNING so the change shows up at any level but the quietest
+        logger.warning("log level is now %s", logging.getLevelName(level))
+
+    signal.signal(signal.SIGUSR1, handler)
+    signal.signal(signal.SIGUSR2, handler)
@@ -0,0 +1,160 @@
+"""
+Metrics module - live server counters and latency histograms.
+
+Every update is a plain += on a preallocated list slot: no locks and no
+allocation on the request path. Under the threaded engine two threads
+racing on the same slot can, rarely, lose an increment; the numbers are
+for operations, not accounting.
+"""
+
+import heapq
+import time
+from protocol import Opcode
+
+# histogram buckets are powers of two, bucket i holds values in [2^(i-1), 2^i)
+BUCKETS = 40
+
+
+class Histogram(object):
+    """power of two histogram of non-negative integers"""
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+
+    def record(self, value):
+        self.buckets[min(value.bit_length(), BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+
+    def percentile(self, p):
+        """
+        :param p: percentile, 0 - 100
+        :return: upper bound of the bucket holding the p-th percentile, 0 when empty
+        """
+        target = self.count * p / 100.0
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return (1 << i) - 1
+        return 0
+
+    def report(self, name):
+        """:return: key=value tokens summarising the histogram"""
+        mean = self.total // self.count if self.count else 0
+        return ["{}.count={}".format(name, self.count),
+                "{}.mean={}".format(name, mean),
+                "{}.p50={}".format(name, self.percentile(50)),
+                "{}.p99={}".format(name, self.percentile(99)),
+                "{}.max={}".format(name, self.percentile(100))]
+
+
+class Timer(object):
+    """a Histogram of elapsed microseconds (2^10 ns, close enough for a histogram)"""
+
+    def __init__(self):
+        self.histogram = Histogram()
+
+    @staticmethod
+    def start():
+        return time.perf_counter_ns()
+
+    def stop(self, started):
+        """record the time since started, which came from start()"""
+        self.histogram.record((time.perf_counter_ns() - started) >> 10)
+
+    def report(self, name):
+        return self.histogram.report(name + "_us")
+
+
+# why a user was evicted: the outbox policy gave up on them, a write to them
+# timed out, or their connection or listener is gone
+OVERFLOW = "overflow"
+TIMEOUT = "timeout"
+UNREACHABLE = "unreachable"
+EVICTION_CAUSES = (OVERFLOW, TIMEOUT, UNREACHABLE)
+
+
+class Metrics(object):
+    """the server's counters, reported by the STATS opcode"""
+
+    def __init__(self):
+        self.requests = [0] * (max(op.value for op in Opcode) + 1)
+        self.failed_dial_backs = [0]
+        self.outbox_drops = [0]
+        # users evicted, by cause: their outbox overflowed, a write timed out or they could not be reached
+        self.evictions = {cause: 0 for cause in EVICTION_CAUSES}
+        self.rate_limits = [0]
+        self.idle_expirations = [0]
+        self.delivery_timeouts = [0]
+        # bytes before and after compression, for compressed sessions
+        self.compression = [0, 0]
+        self.fan_out_size = Histogram()
+        self.decode = Timer()
+        self.handle = Timer()
+        self.fan_out = Timer()
+
+    def request(self, opcode):
+        self.requests[opcode.value] += 1
+
+    def failed_dial_back(self, n=1):
+        self.failed_dial_backs[0] += n
+
+    def outbox_dropped(self):
+        self.outbox_drops[0] += 1
+
+    def evicted(self, cause):
+        """:param cause: one of EVICTION_CAUSES"""
+        self.evictions[cause] += 1
+
+    def rate_limit(self):
+        self.rate_limits[0] += 1
+
+    def idle_expired(self):
+        self.idle_expirations[0] += 1
+
+    def delivery_timed_out(self):
+        self.delivery_timeouts[0] += 1
+
+    def compressed(self, before, after):
+        self.compression[0] += before
+        self.compression[1] += after
+
+    def report(self, users, rooms, largest=5):
+        """
+        :param users: the server's USERS
+        :param rooms: the server's ROOMS, room -> set of members
+        :param largest: how many of the largest rooms, and deepest outboxes, to list
+        :return: list of key=value tokens
+        """
+        tokens = ["users={}".format(len(users)),
+                  "rooms={}".format(len(rooms)),
+                  "failed_dial_backs={}".format(self.failed_dial_backs[0]),
+                  "rate_limited={}".format(self.rate_limits[0]),
+                  "idle_expired={}".format(self.idle_expirations[0]),
+                  "delivery_timeouts={}".format(self.delivery_timeouts[0])]
+        for room, members in heapq.nlargest(largest, list(rooms.items()), key=lambda item: len(item[1])):
+            tokens.append("room.{}={}".format(room, len(members)))
+
+        depths = [(len(user.outbox), nick) for nick, user in list(users.items()) if user.outbox is not None]
+        tokens += ["outbox.queued={}".format(sum(depth for depth, nick in depths)),
+                   "outbox.max={}".format(max([depth for depth, nick in depths], default=0)),
+                   "outbox.dropped={}".format(self.outbox_drops[0]),
+                   "outbox.evicted={}".format(self.evictions[OVERFLOW]),
+                   "evicted.timeout={}".format(self.evictions[TIMEOUT]),
+                   "evicted.unreachable={}".format(self.evictions[UNREACHABLE]),
+                   "compression.in={}".format(self.compression[0]),
+                   "compression.out={}".format(self.compression[1])]
+        for depth, nick in heapq.nlargest(largest, depths):
+            if depth:
+                tokens.append("outbox.{}={}".format(nick, depth))
+        for op in Opcode:
+            if self.requests[op.value]:
+                tokens.append("requests.{}={}".format(op.name, self.requests[op.value]))
+        tokens += self.fan_out_size.report("fan_out_size")
+        tokens += self.decode.report("decode")
+        tokens += self.handle.report("handle")
+        tokens += self.fan_out.report("fan_out")
+        return tokens
@@ -0,0 +1,239 @@
+"""
+Message log module - a durable, segmented, append-only log of room traffic.
+
+Each record is a header, then the packet exactly as it was delivered:
+
+    u32 payload length | u64 sequence number | u64 time in ns since the epoch | payload
+
+Records go to segment files named after the sequence number of their first
+record, 00000000000000000000.log and so on, and a new segment is started once
+one reaches segment_bytes. Every segment has a sparse index, the .idx file
+next to it, holding (sequence number, time, offset) for the first record and
+then for a record every index_every bytes. A reader maps a segment and its
+index, bisects the index and scans at most index_every bytes from there.
+
+append() only queues the record. A writer thread waits commit_interval after
+the first record of a batch, writes everything queued by then and calls fsync
+once for the lot (group commit), so fsync never runs on a request handler and
+runs at most once per commit_interval however busy the server is. A record is
+durable within about commit_interval plus one fsync of being appended.
+
+Dump a log with
+
+    python msglog.py DIRECTORY [--seq N | --since SECONDS_AGO]
+
+"""
+
+import argparse
+import bisect
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+
+HEADER = struct.Struct("!IQQ")
+INDEX_ENTRY = struct.Struct("!QQQ")
+
+SEGMENT_BYTES = 16 * 1024 * 1024
+INDEX_EVERY = 4096
+COMMIT_INTERVAL = 0.005
+
+
+def segment_name(first_seq, suffix):
+    return "{:020d}{}".format(first_seq, suffix)
+
+
+class MessageLog(object):
+    """an append-only log in directory, see the module docstring"""
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, index_every=INDEX_EVERY,
+                 commit_interval=COMMIT_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_every = index_every
+        self.commit_interval = commit_interval
+        os.makedirs(directory, exist_ok=True)
+
+        self.records = queue.SimpleQueue()
+        self.file = None
+        self.index = None
+        self.next_seq = 0
+        self._recover()
+
+        self.writer = threading.Thread(target=self._write_loop, name="message-log", daemon=True)
+        self.writer.start()
+
+    def append(self, payload):
+        """
+        queue a delivered packet for the log, it is numbered and timed now
+
+        :param payload: the encoded packet
+        """
+        self.records.put((time.time_ns(), payload))
+
+    def close(self):
+        """write and fsync everything appended so far, then stop the writer"""
+        self.records.put(None)
+        self.writer.join()
+
+    def _path(self, first_seq, suffix):
+        return os.path.join(self.directory, segment_name(first_seq, suffix))
+
+    def _recover(self):
+        """
+        reopen the newest segment for appending: drop a record torn by a crash
+        and rebuild the index entries that did not make it to disk
+        """
+        firsts = segments(self.directory)
+        if not firsts:
+            self._open_segment(0)
+            return
+
+        first_seq = firsts[-1]
+        path = self._path(first_seq, ".log")
+        entries = []
+        end = 0
+        seq = first_seq
+        last_indexed = -self.index_every
+        with open(path, "rb") as f:
+            data = f.read()
+        while end + HEADER.size <= len(data):
+            length, seq, timestamp = HEADER.unpack_from(data, end)
+            if end + HEADER.size + length > len(data):
+                break
+            if end - last_indexed >= self.index_every:
+                entries.append(INDEX_ENTRY.pack(seq, timestamp, end))
+                last_indexed = end
+            end += HEADER.size + length
+            seq += 1
+        self.next_seq = seq if end else first_seq
+
+        with open(path, "r+b") as f:
+            f.truncate(end)
+        with open(self._path(first_seq, ".idx"), "wb") as f:
+            f.write(b"".join(entries))
+        self._open_segment(first_seq, end, last_indexed)
+
+    def _open_segment(self, first_seq, size=0, last_indexed=None):
+        if self.file is not None:
+            self._sync()
+            self.file.close()
+            self.index.close()
+        self.file = open(self._path(first_seq, ".log"), "ab")
+        self.index = open(self._path(first_seq, ".idx"), "ab")
+        self.size = size
+        self.last_indexed = -self.index_every if last_indexed is None else last_indexed
+
+    def _write(self, timestamp, payload):
+        if self.size and self.size + HEADER.size + len(payload) > self.segment_bytes:
+            self._open_segment(self.next_seq)
+        if self.size - self.last_indexed >= self.index_every:
+            self.index.write(INDEX_ENTRY.pack(self.next_seq, timestamp, self.size))
+            self.last_indexed = self.size
+        self.file.write(HEADER.pack(len(payload), self.next_seq, timestamp))
+        self.file.write(payload)
+        self.size += HEADER.size + len(payload)
+        self.next_seq += 1
+
+    def _sync(self):
+        self.file.flush()
+        self.index.flush()
+        os.fsync(self.file.fileno())
+        os.fsync(self.index.fileno())
+
+    def _write_loop(self):
+        while True:
+            # group commit: everything queued within commit_interval goes in one batch
+            batch = [self.records.get()]
+            time.sleep(self.commit_interval)
+            while True:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    self._sync()
+                    self.file.close()
+                    self.index.close()
+                    return
+                self._write(*record)
+            self._sync()
+
+    def read(self, seq=None, since=None):
+        """read records back, see read()"""
+        return read(self.directory, seq, since)
+
+
+def segments(directory):
+    """:return: the first sequence numbers of the segments in directory, oldest first"""
+    return sorted(int(name[:-4]) for name in os.listdir(directory) if name.endswith(".log"))
+
+
+def index_entries(directory, first_seq, limit=-1):
+    """:return: a segment's index, as (sequence number, time, offset) tuples"""
+    with open(os.path.join(directory, segment_name(first_seq, ".idx")), "rb") as f:
+        data = f.read(limit * INDEX_ENTRY.size if limit >= 0 else -1)
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    return list(INDEX_ENTRY.iter_unpack(data[:usable]))
+
+
+def scan(directory, first_seq, offset):
+    """yield the complete records of a segment from offset on, through a memory map"""
+    with open(os.path.join(directory, segment_name(first_seq, ".log")), "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while offset + HEADER.size <= len(mm):
+                length, seq, timestamp = HEADER.unpack_from(mm, offset)
+                start = offset + HEADER.size
+                if start + length > len(mm):
+                    return
+                yield seq, timestamp, mm[start:start + length]
+                offset = start + length
+
+
+def read(directory, seq=None, since=None):
+    """
+    read a log back, seeking with the segment names and indexes. Safe to
+    call while a MessageLog is appending to it.
+
+    :param directory: the log's directory
+    :param seq: start at the record with this sequence number
+    :param since: or start at the first record at or after this time, ns since the epoch
+    :return: generator of (sequence number, time in ns, payload)
+    """
+    firsts = segments(directory)
+    if seq is not None:
+        key, field = seq, 0
+        keys = firsts
+    else:
+        key, field = since or 0, 1
+        heads = [index_entries(directory, first_seq, 1) for first_seq in firsts]
+        keys = [head[0][1] if head else 0 for head in heads]
+    start = max(bisect.bisect_right(keys, key) - 1, 0)
+
+    for first_seq in firsts[start:]:
+        entries = index_entries(directory, first_seq)
+        i = bisect.bisect_right([entry[field] for entry in entries], key) - 1
+        offset = entries[i][2] if i >= 0 else 0
+        for record in scan(directory, first_seq, offset):
+            if record[field] >= key:
+                yield record
+
+
+if __name__ == '__main__':
+    import protocol
+
+    parser = argparse.ArgumentParser(description="print the records of a message log")
+    parser.add_argument("directory")
+    parser.add_argument("--seq", type=int, default=None, help="start at this sequence number")
+    parser.add_argument("--since", type=float, default=None, help="start this many seconds ago")
+    args = parser.parse_args()
+
+    since = None if args.since is None else time.time_ns() - int(args.since * 1e9)
+    for seq, timestamp, payload in read(args.directory, args.seq, since):
+        print(seq, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp / 1e9)),
+              protocol.decode(payload).__str__().strip())
@@ -3,6 +3,8 @@ Protocol module - Used to implement the IRC Protocol
 according to the RFC documentation in this repository.
 """
 
+import struct
+import zlib
 from enum import Enum, unique
 
 __author__ = "Lisa Gray"
@@ -24,6 +26,37 @@ class Status(Enum):
         return self.name
 
 
+# Connect.config connection modes
+SESSION = "session"
+DIAL_BACK = "dialback"
+
+# Connect.config wire formats, 1 is space separated text and 2 the binary framing
+WIRE_TEXT = 1
+WIRE_BINARY = 2
+
+# Connect.config compression. A session that asks for COMPRESS_ZLIB and gets it
+# back is a deflate stream both ways from the packet after the CONNECT response,
+# see Deflater and StreamDecoder.inflate(); the server answers COMPRESS_NONE to refuse
+COMPRESS_ZLIB = "zlib"
+COMPRESS_NONE = "none"
+
+# the err of a packet refused by the server's rate limits, followed by
+# retry_after=SECONDS, how long until the same packet would be accepted
+RATE_LIMITED = "rate limited"
+
+
+def rate_limited(seconds):
+    """:return: the err for a packet refused by a rate limit, retry after seconds"""
+    return "{} retry_after={:.3f}".format(RATE_LIMITED, seconds)
+
+
+def retry_after(err):
+    """:return: the seconds a rate limited err asks to wait, None for any other err"""
+    if err is None or not err.startswith(RATE_LIMITED + " retry_after="):
+        return None
+    return float(err[len(RATE_LIMITED + " retry_after="):])
+
+
 @unique
 class Opcode(Enum):
     CONNECT = 1
@@ -37,13 +70,21 @@ class Opcode(Enum):
     CREATE = 9
     DESTROY = 10
     # FILE_TRANSFER = 11 - to be implemented later
+    STATS = 12
+    PING = 13
+    PONG = 14
 
     def __str__(self):
         return self.name
 
 
 class Packet(object):
-    """generic packet class"""
+    """
+    generic packet class. Packets and their subclasses declare __slots__, a
+    packet is then its fields and nothing else, without a dict per instance
+    """
+
+    __slots__ = ("opcode", "status", "err")
 
     def __init__(self, opcode, status, err=None):
         self.opcode = opcode
@@ -56,8 +97,26 @@ class Packet(object):
                 + self.status.__str__() + " "
                 + self.err.__str__() + "\n").encode()
 
+    def __repr__(self):
+        """the encoded packet, so log calls can pass a packet and only pay for encoding when logged"""
+        return repr(self.encode())
+
 
 class Connect(Packet):
+    """
+    Connect packet, config carries the options a client asks for:
+
+    mode - SESSION keeps this connection open for commands and deliveries,
+           DIAL_BACK (the legacy default) has the server connect back to
+           the client's listener for every delivery
+    wire - WIRE_BINARY asks for packets delivered to this user to use the
+           binary framing, the server answers with the format it accepted
+    idle - set by the server in its response, the seconds a user may go without
+           sending anything, a Ping included, before they are disconnected
+    """
+
+    __slots__ = ("username", "config")
+
     def __init__(self, username, config={}, status=None, err=None):
         super().__init__(Opcode.CONNECT, status, err)
         self.username = username
@@ -67,12 +126,14 @@ class Connect(Packet):
         """encode the message into a string to be sent over TCP socket"""
         return (self.opcode.__str__() + " "
                 + self.username.__str__() + " "
-                + self.config.__str__() + " "
+                + from_dict(self.config) + " "
                 + self.status.__str__() + " "
                 + self.err.__str__() + "\n").encode()
 
 
 class Disconnect(Packet):
+    __slots__ = ("username",)
+
     def __init__(self, username, status=None, err=None):
         super().__init__(Opcode.DISCONNECT, status, err)
         self.username = username
@@ -86,13 +147,19 @@ class Disconnect(Packet):
 
 
 class Message(Packet):
+    __slots__ = ("username", "message", "room")
+
     def __init__(self, username, message, room, status=None, err=None):
         super().__init__(Opcode.MSG, status, err)
         self.username = username
-        self.length = len(message.split())
         self.message = message
         self.room = room
 
+    @property
+    def length(self):
+        """length of the message in words, only the text format carries it"""
+        return len(self.message.split())
+
     def encode(self):
         """encode the message into a string to be sent over TCP socket"""
         return (self.opcode.__str__() + " "
@@ -115,13 +182,19 @@ class Message(Packet):
 
 
 class PrivateMessage(Packet):
+    __slots__ = ("username", "message", "send_to")
+
     def __init__(self, username, message, send_to, status=None, err=None):
         super().__init__(Opcode.PRIVATE_MSG, status, err)
         self.username = username
-        self.length = len(message.split())
         self.message = message
         self.send_to = send_to
 
+    @property
+    def length(self):
+        """length of the message in words, only the text format carries it"""
+        return len(self.message.split())
+
     def encode(self):
         """encode the message into a string to be sent over TCP socket"""
         return (self.opcode.__str__() + " "
@@ -144,13 +217,22 @@ class PrivateMessage(Packet):
 
 
 class Broadcast(Packet):
+    __slots__ = ("username", "message", "rooms")
+
     def __init__(self, username, message, rooms=None, status=None, err=None):
         super().__init__(Opcode.BROADCAST_MSG, status, err)
         self.username = username
-        self.length = len(message.split())
         self.message = message
-        self.rooms = " ".join(rooms)
-        self.num_of_rooms = len(rooms)
+        self.rooms = () if rooms is None else tuple(rooms)
+
+    @property
+    def num_of_rooms(self):
+        return len(self.rooms)
+
+    @property
+    def length(self):
+        """length of the message in words, only the text format carries it"""
+        return len(self.message.split())
 
     def encode(self):
         return (self.opcode.__str__() + " "
@@ -158,9 +240,9 @@ class Broadcast(Packet):
                 + self.length.__str__() + " "
                 + self.message.__str__() + " "
                 + self.num_of_rooms.__str__() + " "
-                + self.rooms.__str__() + " "
+                + " ".join(self.rooms) + " "
                 + self.status.__str__() + " "
-                + self.err.__str__()).encode()
+                + self.err.__str__() + "\n").encode()
 
     def __str__(self):
         return (self.opcode.__str__() + " "
@@ -168,12 +250,14 @@ class Broadcast(Packet):
                 + self.length.__str__() + " "
                 + self.message.__str__() + " "
                 + self.num_of_rooms.__str__() + " "
-                + self.rooms.__str__() + " "
+                + " ".join(self.rooms) + " "
                 + self.status.__str__() + " "
-                + self.err.__str__())
+                + self.err.__str__() + "\n")
 
 
 class List(Packet):
+    __slots__ = ("room", "length", "response")
+
     def __init__(self, room=None, response=None, status=None, err=None):
         super().__init__(Opcode.LIST, status, err)
         self.room = room
@@ -200,6 +284,8 @@ class List(Packet):
 
 
 class Join(Packet):
+    __slots__ = ("username", "room")
+
     def __init__(self, username, room, status=None, err=None):
         super().__init__(Opcode.JOIN, status, err)
         self.username = username
@@ -215,6 +301,8 @@ class Join(Packet):
 
 
 class Leave(Packet):
+    __slots__ = ("username", "room")
+
     def __init__(self, username, room, status=None, err=None):
         super().__init__(Opcode.LEAVE, status, err)
         self.username = username
@@ -230,6 +318,8 @@ class Leave(Packet):
 
 
 class Create(Packet):
+    __slots__ = ("room",)
+
     def __init__(self, room, status=None, err=None):
         super().__init__(Opcode.CREATE, status, err)
         self.room = room
@@ -243,6 +333,8 @@ class Create(Packet):
 
 
 class Destroy(Packet):
+    __slots__ = ("room",)
+
     def __init__(self, room, status=None, err=None):
         super().__init__(Opcode.DESTROY, status, err)
         self.room = room
@@ -255,14 +347,99 @@ class Destroy(Packet):
                 + self.err.__str__() + "\n").encode()
 
 
+class Stats(Packet):
+    """Stats packet, the server answers with a list of key=value tokens in response"""
+
+    __slots__ = ("response",)
+
+    def __init__(self, response=None, status=None, err=None):
+        super().__init__(Opcode.STATS, status, err)
+        self.response = [] if response is None else response
+
+    def encode(self):
+        """encode the message into a string to be sent over TCP socket"""
+        return (self.opcode.__str__() + " "
+                + len(self.response).__str__() + " "
+                + "".join(token + " " for token in self.response)
+                + self.status.__str__() + " "
+                + self.err.__str__() + "\n").encode()
+
+
+class Ping(Packet):
+    """
+    Ping packet, a client's heartbeat. The server answers with a Pong and
+    disconnects users it has not heard anything from for a while, the
+    Connect response's config says how long as idle=SECONDS.
+    """
+
+    __slots__ = ("username",)
+
+    def __init__(self, username, status=None, err=None):
+        super().__init__(Opcode.PING, status, err)
+        self.username = username
+
+    def encode(self):
+        """encode the message into a string to be sent over TCP socket"""
+        return (self.opcode.__str__() + " "
+                + self.username.__str__() + " "
+                + self.status.__str__() + " "
+                + self.err.__str__() + "\n").encode()
+
+
+class Pong(Packet):
+    """Pong packet, the answer to a Ping"""
+
+    __slots__ = ("username",)
+
+    def __init__(self, username, status=None, err=None):
+        super().__init__(Opcode.PONG, status, err)
+        self.username = username
+
+    def encode(self):
+        """encode the message into a string to be sent over TCP socket"""
+        return (self.opcode.__str__() + " "
+                + self.username.__str__() + " "
+                + self.status.__str__() + " "
+                + self.err.__str__() + "\n").encode()
+
+
+def response_opcode(opcode):
+    """:return: the opcode of the server's answer to a packet of opcode"""
+    return Opcode.PONG if opcode == Opcode.PING else opcode
+
+
+def encode(packet, wire=WIRE_TEXT):
+    """
+    encode a packet in the given wire format
+
+    :param packet: the Packet to encode
+    :param wire: WIRE_TEXT or WIRE_BINARY
+    :return: bytes
+    """
+    if wire == WIRE_BINARY:
+        return encode_v2(packet)
+    return packet.encode()
+
+
+def wire_of(frame):
+    """
+    :param frame: the bytes of one packet
+    :return: the wire format the packet was sent in
+    """
+    return WIRE_BINARY if frame[:1] == V2_MAGIC_BYTE else WIRE_TEXT
+
+
 def decode(arg):
     """
     decode the argument into a packet
 
-    :param arg: a string representation of a packet
+    :param arg: a string representation of a packet or a binary frame
     :return: a packet class of Type
     """
-    packet = arg.decode().split(" ")
+    if arg[:1] == V2_MAGIC_BYTE:
+        return decode_v2(arg)
+
+    packet = arg.decode().strip().split(" ")
     packet = decode_dictionary[packet[0]](packet)
     if packet is None:
         raise TypeError
@@ -340,7 +517,7 @@ def decode_list(packet):
     if length == 0:
         response = packet[3]
         status = packet[4]
-        err = packet[5:]
+        err = ' '.join(packet[5:])
     else:
         response = packet[3:(3 + length)]
         status = packet[3 + length]
@@ -410,8 +587,8 @@ def decode_broadcast(packet):
     message = " ".join(ml)
     num_of_rooms = int(packet[3 + msg_length])
     rooms = packet[4 + msg_length: 4 + msg_length + num_of_rooms]
-    status = packet[5 + msg_length + num_of_rooms]
-    err = packet[6 + msg_length + num_of_rooms:]
+    status = packet[4 + msg_length + num_of_rooms]
+    err = ' '.join(packet[5 + msg_length + num_of_rooms:])
 
     if status == "OK":
         packet = Broadcast(username, message, rooms, status=Status.OK)
@@ -422,6 +599,25 @@ def decode_broadcast(packet):
     return packet
 
 
+def decode_stats(packet):
+    """
+    decode a Stats packet
+
+    :param packet: a string representing a Stats packet
+    :return: return a Stats packet object
+    """
+    length = int(packet[1])
+    response = packet[2:2 + length]
+    status = packet[2 + length]
+    if status == "OK":
+        packet = Stats(response, status=Status.OK)
+    elif status == "ERR":
+        packet = Stats(response, status=Status.ERR, err=' '.join(packet[3 + length:]))
+    else:
+        packet = Stats(response)
+    return packet
+
+
 def decode_connect(packet):
     """
     decode a Connect packet
@@ -440,15 +636,30 @@ def decode_connect(packet):
     return packet
 
 
-# (only works with {}, for now)
+def from_dict(config):
+    """
+    encode a config dict as a single space-free token, e.g. {mode:session}
+
+    :param config: dict of str keys and values
+    :return: the encoded string
+    """
+    return "{" + ",".join("{}:{}".format(k, v) for k, v in config.items()) + "}"
+
+
 def to_dict(string):
+    """
+    decode a config token written by from_dict (values come back as str)
+
+    :param string: the encoded config
+    :return: a dict
+    """
     if string == '{}':
         return {}
-    l = string.replace('{', '').replace('}', '').replace('\'', '').split(', ')
+    l = string.replace('{', '').replace('}', '').replace('\'', '').split(',')
     d = {}
     for kv in l:
-        k, v = kv.split(': ')
-        d[k] = v
+        k, v = kv.split(':')
+        d[k.strip()] = v.strip()
     return d
 
 """
@@ -466,4 +677,292 @@ decode_dictionary = {
     "LEAVE": decode_type2(Leave),
     "CREATE": decode_type1(Create),
     "DESTROY": decode_type1(Destroy),
+    "STATS": decode_stats,
+    "PING": decode_type1(Ping),
+    "PONG": decode_type1(Pong),
+}
+
+
+"""
+Protocol v2 binary framing. A frame is
+
+    magic (0xB2) | u32 length of the rest | u8 opcode | u8 status | err | fields
+
+where err and every str field is a u16 byte length followed by UTF-8 bytes
+(0xFFFF for None), a list field is a u16 count of str fields and a dict
+field a u16 count of key, value str fields. Text packets always start with
+an opcode name, so the magic byte tells the formats apart.
+"""
+V2_MAGIC = 0xB2
+V2_MAGIC_BYTE = bytes([V2_MAGIC])
+V2_PREFIX = struct.Struct("!BI")
+V2_U16 = struct.Struct("!H")
+V2_NONE = 0xFFFF
+V2_STATUS_NONE = 0xFF
+
+# the str (s), list (l) and dict (d) fields of each packet type, in constructor order
+V2_LAYOUT = {
+    Opcode.CONNECT: (Connect, (("username", "s"), ("config", "d"))),
+    Opcode.DISCONNECT: (Disconnect, (("username", "s"),)),
+    Opcode.MSG: (Message, (("username", "s"), ("message", "s"), ("room", "s"))),
+    Opcode.PRIVATE_MSG: (PrivateMessage, (("username", "s"), ("message", "s"), ("send_to", "s"))),
+    Opcode.BROADCAST_MSG: (Broadcast, (("username", "s"), ("message", "s"), ("rooms", "l"))),
+    Opcode.LIST: (List, (("room", "s"), ("response", "l"))),
+    Opcode.JOIN: (Join, (("username", "s"), ("room", "s"))),
+    Opcode.LEAVE: (Leave, (("username", "s"), ("room", "s"))),
+    Opcode.CREATE: (Create, (("room", "s"),)),
+    Opcode.DESTROY: (Destroy, (("room", "s"),)),
+    Opcode.STATS: (Stats, (("response", "l"),)),
+    Opcode.PING: (Ping, (("username", "s"),)),
+    Opcode.PONG: (Pong, (("username", "s"),)),
 }
+
+
+def encode_v2(packet):
+    """
+    encode a packet as a v2 binary frame
+
+    :param packet: the Packet to encode
+    :return: bytes
+    """
+    parts = [bytes([packet.opcode.value,
+                    V2_STATUS_NONE if packet.status is None else packet.status.value])]
+    _put_str(parts, packet.err)
+    for name, kind in V2_LAYOUT[packet.opcode][1]:
+        value = getattr(packet, name)
+        if kind == "s":
+            _put_str(parts, value)
+        elif value is None:
+            parts.append(V2_U16.pack(V2_NONE))
+        elif kind == "l":
+            # space separated strings (a server side List.response)
+            if isinstance(value, str):
+                value = value.split(" ") if value else []
+            parts.append(V2_U16.pack(len(value)))
+            for item in value:
+                _put_str(parts, item)
+        else:
+            parts.append(V2_U16.pack(len(value)))
+            for k, v in value.items():
+                _put_str(parts, k)
+                _put_str(parts, v)
+    body = b"".join(parts)
+    return V2_PREFIX.pack(V2_MAGIC, len(body)) + body
+
+
+def _put_str(parts, value):
+    if value is None:
+        parts.append(V2_U16.pack(V2_NONE))
+    else:
+        data = str(value).encode()
+        parts.append(V2_U16.pack(len(data)))
+        parts.append(data)
+
+
+def decode_v2(frame):
+    """
+    decode a v2 binary frame, reading each field straight out of the buffer
+
+    :param frame: the bytes of a complete frame
+    :return: a packet class of Type
+    """
+    buf = memoryview(frame)
+    offset = V2_PREFIX.size
+    protocol_type, layout = V2_LAYOUT[Opcode(buf[offset])]
+    status = buf[offset + 1]
+    status = None if status == V2_STATUS_NONE else Status(status)
+    err, offset = _get_str(buf, offset + 2)
+
+    values = []
+    for name, kind in layout:
+        if kind == "s":
+            value, offset = _get_str(buf, offset)
+        else:
+            count = V2_U16.unpack_from(buf, offset)[0]
+            offset += V2_U16.size
+            if count == V2_NONE:
+                value = None
+            elif kind == "l":
+                value = []
+                for _ in range(count):
+                    item, offset = _get_str(buf, offset)
+                    value.append(item)
+            else:
+                value = {}
+                for _ in range(count):
+                    k, offset = _get_str(buf, offset)
+                    value[k], offset = _get_str(buf, offset)
+        values.append(value)
+    return protocol_type(*values, status=status, err=err)
+
+
+def _get_str(buf, offset):
+    length = V2_U16.unpack_from(buf, offset)[0]
+    offset += V2_U16.size
+    if length == V2_NONE:
+        return None, offset
+    return str(buf[offset:offset + length], "utf-8"), offset + length
+
+
+def read_frame(rfile):
+    """
+    read the bytes of one packet, a text line or a v2 frame, from a buffered file
+
+    :param rfile: a binary file object
+    :return: the packet's bytes, b'' at EOF
+    """
+    first = rfile.read(1)
+    if first == V2_MAGIC_BYTE:
+        prefix = first + rfile.read(V2_PREFIX.size - 1)
+        if len(prefix) < V2_PREFIX.size:
+            return b""
+        return prefix + rfile.read(V2_PREFIX.unpack(prefix)[1])
+    elif first:
+        return first + rfile.readline()
+    return first
+
+
+class FrameError(Exception):
+    """
+    This exception is raised when a stream carries a frame that is too large to accept
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return repr(self.value)
+
+
+# largest packet a StreamDecoder accepts by default, text line or v2 frame
+MAX_FRAME_SIZE = 64 * 1024
+
+
+class StreamDecoder(object):
+    """
+    Incremental decoder for a stream of packets. Feed it byte chunks as they
+    are received, in any sizes, and it hands back each packet once all of it
+    has arrived. Text lines and v2 frames may be mixed on one stream.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+        self.inflater = None
+
+    def feed(self, data):
+        """
+        add received bytes to the stream
+
+        :param data: a chunk of bytes
+        :return: a generator of the frames completed so far, see frames()
+        """
+        if self.inflater is not None:
+            self.inflater.feed(data)
+        else:
+            self.buffer += data
+        return self.frames()
+
+    def inflate(self):
+        """
+        decompress the stream from here on: everything after the frame frames()
+        last handed back, already buffered or not, is read as a Deflater's output
+        """
+        self.inflater = Inflater()
+
+    def frames(self):
+        """
+        yield the bytes of every complete packet in the buffer, keeping any partial
+        one for the next feed. Raises FrameError for a packet over max_frame_size.
+        """
+        buffer = self.buffer
+        start = 0
+        try:
+            while True:
+                end = self._frame_end(start)
+                if end is None:
+                    # inflate no more than a frame's worth at a time, however well it compressed
+                    if self.inflater is None or not self.inflater.pending:
+                        return
+                    del buffer[:start]
+                    start = 0
+                    buffer += self.inflater.read(self.max_frame_size)
+                    continue
+                frame = bytes(buffer[start:end])
+                start = end
+                inflating = self.inflater is not None
+                yield frame
+                if self.inflater is not None and not inflating:
+                    # inflate() was called for this frame, the rest of the buffer is compressed
+                    self.inflater.feed(bytes(buffer[start:]))
+                    del buffer[start:]
+        finally:
+            del buffer[:start]
+
+    def _frame_end(self, start):
+        """:return: where the packet starting at start ends, None if it is not all here yet"""
+        buffer = self.buffer
+        if start >= len(buffer):
+            return None
+        if buffer[start] == V2_MAGIC:
+            if len(buffer) - start < V2_PREFIX.size:
+                return None
+            end = start + V2_PREFIX.size + V2_PREFIX.unpack_from(buffer, start)[1]
+            if end - start > self.max_frame_size:
+                raise FrameError("frame of {} bytes is over the limit".format(end - start))
+            return end if end <= len(buffer) else None
+        # a line ending past the limit is too long however it arrived, so look no further
+        end = buffer.find(b"\n", start, start + self.max_frame_size) + 1
+        if end == 0:
+            if len(buffer) - start >= self.max_frame_size:
+                raise FrameError("line is over the limit of {} bytes".format(self.max_frame_size))
+            return None
+        return end
+
+    def packets(self):
+        """yield every complete packet in the buffer, decoded"""
+        for frame in self.frames():
+            yield decode(frame)
+
+
+class Deflater(object):
+    """
+    The sending side of a compressed stream. Each packet is flushed on its own,
+    so the peer can decode it as soon as it arrives, but the window spans the
+    packets before it: a nick, room or status trailer sent recently costs a few
+    bits. A compressor takes about 256 KiB, an Inflater about 40 KiB.
+    """
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION):
+        self.compressor = zlib.compressobj(level)
+
+    def compress(self, data):
+        """
+        :param data: encoded packets
+        :return: their compressed bytes, everything the peer needs to decode them
+        """
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class Inflater(object):
+    """The receiving side of a compressed stream, see StreamDecoder.inflate()"""
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj()
+        self.pending = b""
+
+    def feed(self, data):
+        """add received compressed bytes"""
+        self.pending += data
+
+    def read(self, size):
+        """
+        :param size: the most bytes to return
+        :return: decompressed bytes, b'' once everything fed is decompressed
+        """
+        try:
+            data = self.decompressor.decompress(self.pending, size)
+        except zlib.error as e:
+            raise FrameError("bad compressed stream: {}".format(e))
+        self.pending = self.decompressor.unconsumed_tail
+        return data
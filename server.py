@@ -1,9 +1,29 @@
 import socketserver
 import socket
+import multiprocessing
+import os
+import shutil
+import tempfile
+import asyncio
+import collections
+import concurrent.futures
+import argparse
+import errno
+import gc
 import logging
+import logsink
+import broker
 import protocol
+import metrics
+import msglog
+import snapshot
+import state
+import timerwheel
+import select
 import signal
 import sys
+import threading
+import time
 from protocol import Opcode
 from protocol import Status
 from User import User
@@ -11,16 +31,73 @@ from User import User
 # set up host and port
 HOST, PORT = "0.0.0.0", 9999
 
-# set up logging
-logging.basicConfig(format='%(asctime)s %(message)s')
+# set up logging, records are written by logsink's writer thread once configured
 logger = logging.getLogger("server-log")
 logger.setLevel(logging.DEBUG)
 
 # initialize USERS and ROOMS data structures
-USERS = {}
-ROOMS = []
+# ROOMS maps each room to the set of nicks in it
+# ADDRESSES maps each user's listener address back to their nick
+# nicks and room names are interned where they are first stored, see User
+# the dicts are read directly, every change goes through STATE, see state
+STATE = state.StateStore()
+USERS = STATE.users
+ROOMS = STATE.rooms
+ADDRESSES = STATE.addresses
 SERVER_SOCKET = None
 
+# live counters and latency histograms, reported by STATS
+METRICS = metrics.Metrics()
+
+# the running event loop when serving with the asyncio engine
+EVENT_LOOP = None
+
+# room -> RoomHistory, for rooms that have been messaged
+HISTORIES = {}
+
+# where to keep a durable log of room and broadcast messages, see msglog, and
+# the MessageLog writing it once serving; None keeps no log
+MESSAGE_LOG_DIR = None
+MESSAGE_LOG = None
+
+# where to save snapshots of USERS and ROOMS, see snapshot, and every how many
+# seconds besides at shutdown; None saves none
+SNAPSHOT_PATH = None
+SNAPSHOT_INTERVAL = 60.0
+
+# in a worker of a multi-process server, see serve_workers: the worker's
+# number and its BrokerLink to the other workers, and how many workers there are
+WORKER_ID = None
+BROKER = None
+WORKERS = 0
+
+# bytes read from a connection per recv, and the largest packet accepted
+RECV_SIZE = 64 * 1024
+MAX_FRAME_SIZE = protocol.MAX_FRAME_SIZE
+
+# zlib level for sessions that ask for compression, 0 refuses them
+COMPRESSION_LEVEL = 6
+
+# token buckets in front of fan-out, see TokenBucket: tokens a second and the
+# burst for each user's MSG, PRIVATE_MSG and BROADCAST_MSG packets, and for the
+# MSG and BROADCAST_MSG packets to each room. A rate of 0 turns that limit off
+USER_RATE = 0.0
+USER_BURST = 20
+ROOM_RATE = 0.0
+ROOM_BURST = 50
+RATE_LIMITED_OPCODES = (Opcode.MSG, Opcode.PRIVATE_MSG, Opcode.BROADCAST_MSG)
+
+# room -> TokenBucket, for rooms messaged while ROOM_RATE is on
+ROOM_BUCKETS = {}
+
+# seconds a user may go without sending anything, a PING included, before
+# they are disconnected, 0 never disconnects them, and how often to check
+IDLE_TIMEOUT = 90.0
+IDLE_TICK = 1.0
+
+# the TimerWheel of this process's users' idle deadlines once serving, see heard_from()
+IDLE_WHEEL = None
+
 
 class Disconnection(Exception):
     """
@@ -34,18 +111,846 @@ class Disconnection(Exception):
         return repr(self.value)
 
 
+# seconds a kept-alive dial-back connection may sit unused before it is closed
+DIAL_BACK_IDLE = 30.0
+
+# errors that mean a legacy user's listener is gone, not just one failed delivery
+DEAD_LISTENER = (errno.ECONNREFUSED, errno.EPIPE, errno.ECONNRESET)
+
+# drainers writing Outboxes at once, and seconds one delivery may take before it is given up
+FAN_OUT_WORKERS = 32
+DELIVERY_TIMEOUT = 5.0
+# packets a drainer writes for one user before going to the back of the queue
+DRAIN_BATCH = 64
+# the threads engine's drainers, made by serve_threads(). The asyncio engine's
+# drain tasks wait on DRAIN_SLOTS instead
+DRAINERS = None
+DRAIN_SLOTS = None
+
+# what a full Outbox does with one more delivery, see Outbox
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+DISCONNECT = "disconnect"
+OUTBOX_POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+# packets an Outbox holds before its policy applies, and the policy
+OUTBOX_SIZE = 1024
+OUTBOX_POLICY = DISCONNECT
+
+# what Outbox.put asks of its caller
+QUEUED, START, DROPPED, OVERFLOW = range(4)
+
+
+class Outbox(object):
+    """
+    The bounded queue of encoded packets on their way to one user. Fan-out and
+    responses only append to it and a single drainer at a time writes it out, so a
+    slow recipient holds up neither the sender nor the other recipients.
+
+    Once size deliveries are waiting the policy decides: DROP_OLDEST discards the
+    oldest waiting delivery, DROP_NEWEST the one being added and DISCONNECT evicts
+    the user. Responses are never dropped, a client that lets twice size of them
+    pile up has stopped reading and is evicted under any policy.
+
+    For a compressed session packets are compressed as they are queued, in the
+    order they will be written. A compressed packet cannot be taken back out of
+    the stream, so DROP_OLDEST discards the one being added for them instead.
+    """
+
+    __slots__ = ("size", "policy", "items", "lock", "draining", "closed", "deflater")
+
+    def __init__(self, size, policy):
+        self.size = size
+        self.policy = policy
+        # [droppable, data] pairs, oldest first. An empty deque costs most of a
+        # kilobyte, so an idle user's outbox holds an empty tuple instead
+        self.items = ()
+        self.lock = threading.Lock()
+        self.draining = False
+        self.closed = False
+        self.deflater = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, data, response=False, start_compression=False):
+        """
+        queue an encoded packet
+
+        :param data: the encoded packet
+        :param response: True for a response to the user's own command
+        :param start_compression: True for the response that agreed to compress the
+                                  session, the last packet queued uncompressed
+        :return: START when the caller must start a drain, QUEUED when one is already
+                 running, DROPPED when the packet was discarded and OVERFLOW when
+                 the user must be evicted
+        """
+        with self.lock:
+            if self.closed:
+                return DROPPED
+            if len(self.items) >= self.size:
+                if response:
+                    if len(self.items) >= 2 * self.size:
+                        return OVERFLOW
+                elif self.policy == DROP_NEWEST or self.policy == DROP_OLDEST and self.deflater is not None:
+                    return DROPPED
+                elif self.policy == DISCONNECT or not self._drop_oldest():
+                    return OVERFLOW
+            if self.deflater is not None:
+                compressed = self.deflater.compress(data)
+                METRICS.compressed(len(data), len(compressed))
+                data = compressed
+            elif start_compression:
+                self.deflater = protocol.Deflater(COMPRESSION_LEVEL)
+            if not self.items:
+                self.items = collections.deque()
+            self.items.append([not response, data])
+            if self.draining:
+                return QUEUED
+            self.draining = True
+            return START
+
+    def _drop_oldest(self):
+        """:return: False if nothing waiting can be dropped"""
+        for item in self.items:
+            if item[0]:
+                self.items.remove(item)
+                METRICS.outbox_dropped()
+                return True
+        return False
+
+    def take(self):
+        """
+        :return: the next packet to write, or None once the queue is empty,
+                 which also ends the caller's drain
+        """
+        with self.lock:
+            if not self.items or self.closed:
+                self.items = ()
+                self.draining = False
+                return None
+            return self.items.popleft()[1]
+
+    def requeue(self, data):
+        """put back the unwritten tail of a packet, it is written next and never dropped"""
+        with self.lock:
+            if not self.items:
+                self.items = collections.deque()
+            self.items.appendleft([False, data])
+
+    def close(self):
+        """discard everything waiting, later packets are dropped"""
+        with self.lock:
+            self.closed = True
+            self.items = ()
+
+
+class DialBackPool(object):
+    """
+    Kept-alive connections to the listeners of legacy users, keyed by listener
+    address, so a delivery does not pay for a connect() and close() each time.
+    A connection is checked out while a user's drainer writes to it, connections
+    left idle for idle_timeout are closed by reap().
+    """
+
+    def __init__(self, idle_timeout):
+        self.idle_timeout = idle_timeout
+        # address -> (connection, when it was last checked in)
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def checkout(self, address):
+        """:return: the kept-alive connection to address, or None if there is no open one"""
+        with self.lock:
+            entry = self.connections.pop(address, None)
+        if entry is None:
+            return None
+        if self._closed_by_peer(entry[0]):
+            self._close(entry[0])
+            return None
+        return entry[0]
+
+    def checkin(self, address, connection):
+        """keep a connection open for the next delivery to address"""
+        with self.lock:
+            entry = self.connections.get(address)
+            self.connections[address] = (connection, time.monotonic())
+        if entry is not None:
+            self._close(entry[0])
+
+    def discard(self, address):
+        """close the kept-alive connection to address, if there is one"""
+        with self.lock:
+            entry = self.connections.pop(address, None)
+        if entry is not None:
+            self._close(entry[0])
+
+    def reap(self):
+        """close the connections idle for longer than idle_timeout"""
+        oldest = time.monotonic() - self.idle_timeout
+        with self.lock:
+            idle = [address for address, entry in self.connections.items() if entry[1] < oldest]
+            entries = [self.connections.pop(address) for address in idle]
+        for entry in entries:
+            self._close(entry[0])
+
+    def send(self, address, data):
+        """
+        write an encoded packet to the listener at address, over the kept-alive
+        connection when there is one
+
+        :raise socket.error: when the listener cannot be reached or written to,
+                             socket.timeout when that takes longer than DELIVERY_TIMEOUT
+        """
+        s = self.checkout(address)
+        if s is None:
+            # the timeout stays with the connection, for every write to it
+            s = socket.create_connection(address, DELIVERY_TIMEOUT or None)
+        try:
+            write_buffers(s, [data])
+        except socket.error:
+            s.close()
+            raise
+        self.checkin(address, s)
+
+    @staticmethod
+    def _closed_by_peer(sock):
+        # listeners never write back, so a readable connection has been closed.
+        # poll, unlike select, takes descriptors past FD_SETSIZE
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return bool(poller.poll(0))
+
+    @staticmethod
+    def _close(sock):
+        sock.close()
+
+
+class AsyncDialBackPool(DialBackPool):
+    """A DialBackPool for the asyncio engine, its connections are (reader, writer) streams"""
+
+    async def send_async(self, address, data):
+        """
+        write an encoded packet to the listener at address, waiting
+        for the write to drain so one user's deliveries do not pile up
+
+        :raise socket.error: when the listener cannot be reached or written to,
+                             socket.timeout when that takes longer than DELIVERY_TIMEOUT
+        """
+        timeout = DELIVERY_TIMEOUT or None
+        stream = self.checkout(address)
+        try:
+            if stream is None:
+                stream = await asyncio.wait_for(asyncio.open_connection(*address), timeout)
+            stream[1].write(data)
+            # only a write the socket did not take at once can have anything to wait for
+            if stream[1].transport.get_write_buffer_size():
+                await asyncio.wait_for(stream[1].drain(), timeout)
+        except asyncio.TimeoutError:
+            if stream is not None:
+                stream[1].close()
+            raise socket.timeout("delivery timed out")
+        except socket.error:
+            if stream is not None:
+                stream[1].close()
+            raise
+        self.checkin(address, stream)
+
+    def send(self, address, data):
+        """the blocking send, for writing off the event loop such as at shutdown"""
+        self.discard(address)
+        s = socket.create_connection(address, DELIVERY_TIMEOUT or None)
+        write_buffers(s, [data])
+        s.close()
+
+    @staticmethod
+    def _closed_by_peer(stream):
+        return stream[0].at_eof() or stream[1].is_closing()
+
+    @staticmethod
+    def _close(stream):
+        stream[1].close()
+
+
+# kept-alive dial-back connections, a DialBackPool or for the asyncio engine an
+# AsyncDialBackPool, made when the server starts serving
+DIAL_BACKS = None
+
+
+# recent messages kept per room and replayed on JOIN, see RoomHistory, 0 keeps none
+HISTORY_MESSAGES = 100
+HISTORY_BYTES = 64 * 1024
+
+
+class RoomHistory(object):
+    """
+    A ring of the most recent messages to a room, at most size messages and limit
+    bytes, the oldest go first. Messages are kept as the {wire: bytes} that fan-out
+    already encoded, so recording one allocates no more than its ring entry.
+    """
+
+    def __init__(self, size, limit):
+        self.size = size
+        self.limit = limit
+        # (encoded, bytes held) pairs, oldest first
+        self.entries = collections.deque()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def record(self, encoded):
+        """
+        :param encoded: the message encoded for one or more wire formats, wire -> bytes.
+                        Nothing is kept when it is empty, no one was sent the message
+        """
+        if not encoded:
+            return
+        held = 0
+        for data in encoded.values():
+            held += len(data)
+        if held > self.limit:
+            return
+        with self.lock:
+            self.entries.append((encoded, held))
+            self.bytes += held
+            while len(self.entries) > self.size or self.bytes > self.limit:
+                self.bytes -= self.entries.popleft()[1]
+
+    def replay(self, wire):
+        """
+        :param wire: the joiner's wire format
+        :return: every kept message encoded for wire, as one buffer
+        """
+        with self.lock:
+            entries = list(self.entries)
+        batch = []
+        for encoded, held in entries:
+            data = encoded.get(wire)
+            if data is None:
+                if not encoded:
+                    continue
+                data = protocol.encode(protocol.decode(next(iter(encoded.values()))), wire)
+            batch.append(data)
+        return b"".join(batch)
+
+
+class TokenBucket(object):
+    """
+    A bucket of at most burst tokens, refilled at rate tokens a second. The
+    refill is worked out from the time since the last check, so a check is a
+    few float operations and no timer runs. Buckets are not locked: two
+    threads checking one bucket at once can, rarely, both take its last
+    token. The limits guard fan-out against floods, they are not a quota.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = float(self.burst)
+        self.stamp = time.monotonic()
+
+    def wait(self, now):
+        """
+        refill the bucket up to now
+
+        :param now: time.monotonic()
+        :return: seconds until a token is available, 0 when one is
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+def check_rate_limits(packet):
+    """
+    take a token for a MSG, PRIVATE_MSG or BROADCAST_MSG from its sender's
+    bucket and from the bucket of each room it goes to, or take none when
+    any of those buckets is empty. Rooms are only charged for a packet that
+    will reach them, one from a member of every room it names, so nobody
+    can use up a room's tokens from outside it
+
+    :param packet: the packet, before any fan-out
+    :return: seconds until the packet would be accepted, 0 when it was
+    """
+    buckets = []
+    user = USERS.get(packet.username)
+    if USER_RATE > 0 and user is not None:
+        if user.bucket is None:
+            user.bucket = TokenBucket(USER_RATE, USER_BURST)
+        buckets.append(user.bucket)
+    if ROOM_RATE > 0 and user is not None and packet.opcode != Opcode.PRIVATE_MSG:
+        rooms = (packet.room,) if packet.opcode == Opcode.MSG else set(packet.rooms)
+        if not all(room in user.rooms for room in rooms):
+            rooms = ()
+        for room in rooms:
+            bucket = ROOM_BUCKETS.get(room)
+            if bucket is None and room in ROOMS:
+                bucket = ROOM_BUCKETS.setdefault(room, TokenBucket(ROOM_RATE, ROOM_BURST))
+            if bucket is not None:
+                buckets.append(bucket)
+
+    now = time.monotonic()
+    wait = max([bucket.wait(now) for bucket in buckets], default=0.0)
+    if not wait:
+        for bucket in buckets:
+            bucket.take()
+    return wait
+
+
+class Session(object):
+    """
+    A long-lived client connection opened by Connect in SESSION mode.
+    The client's commands are read from it and deliveries are pushed over it,
+    every write goes through the user's Outbox so only its drainer writes.
+    """
+
+    def __init__(self, sock, user):
+        self.sock = sock
+        self.user = user
+        self.nick = user.nick
+
+    def send(self, data, timeout=None):
+        """
+        :param timeout: seconds the whole write may take, None to wait as long as it takes
+        :raise socket.timeout: when the client did not take data in time, some of it may be written
+        """
+        if timeout is None:
+            self.sock.sendall(data)
+            return
+        deadline = time.monotonic() + timeout
+        poller = None
+        view = memoryview(data)
+        while True:
+            view = view[self.send_nowait(view):]
+            if not view:
+                return
+            if poller is None:
+                poller = select.poll()
+                poller.register(self.sock, select.POLLOUT)
+            left = deadline - time.monotonic()
+            if left <= 0 or not poller.poll(left * 1000):
+                raise socket.timeout("delivery timed out")
+
+    def send_nowait(self, data):
+        """
+        :return: how many bytes of data the socket took without blocking
+        """
+        try:
+            return self.sock.send(data, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return 0
+
+    def close(self):
+        """shut the connection down, the session's handler then sees EOF and ends it"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+class AsyncSession(Session):
+    """
+    A Session served by the asyncio engine, writes go to the transport buffer.
+    While the transport asks for writing to pause the Outbox is left to fill,
+    a client that does not take the buffer within DELIVERY_TIMEOUT is evicted.
+    """
+
+    def __init__(self, transport, user, loop):
+        super().__init__(None, user)
+        self.transport = transport
+        self.loop = loop
+        self.paused = False
+        self.stalled = None
+
+    def pause(self):
+        self.paused = True
+        if DELIVERY_TIMEOUT:
+            self.stalled = self.loop.call_later(DELIVERY_TIMEOUT, self._timed_out)
+
+    def resume(self):
+        self.paused = False
+        if self.stalled is not None:
+            self.stalled.cancel()
+            self.stalled = None
+        self.flush()
+
+    def _timed_out(self):
+        METRICS.delivery_timed_out()
+        evict(self.user, metrics.TIMEOUT, "delivery timed out")
+
+    def send(self, data):
+        if self.transport.is_closing():
+            raise ConnectionResetError("session transport is closed")
+        self.transport.write(data)
+
+    def flush(self):
+        """write the Outbox to the transport until it is empty or writing pauses"""
+        outbox = self.user.outbox
+        while not self.paused:
+            data = outbox.take()
+            if data is None:
+                return
+            try:
+                self.send(data)
+            except socket.error:
+                evict(self.user, metrics.UNREACHABLE, "connection lost")
+                return
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.transport.close)
+
+
+def end_session(session):
+    """
+    remove the session's user once its connection is gone, unless it
+    already disconnected or has been replaced
+    """
+    session.user.outbox.close()
+    user = USERS.get(session.nick)
+    if user is not None and user.session is session:
+        drop_user(session.nick)
+        logger.info("user %s session closed", session.nick)
+
+
+def evict(user, cause, reason):
+    """
+    disconnect a recipient that cannot keep up or cannot be reached,
+    whatever is still queued for it is discarded
+
+    :param user: the User to evict
+    :param cause: one of metrics.EVICTION_CAUSES, what it is counted as
+    :param reason: why, for the log
+    """
+    user.outbox.close()
+    if USERS.get(user.nick) is user:
+        drop_user(user.nick)
+        METRICS.evicted(cause)
+        logger.info("evicted user %s: %s", user.nick, reason)
+    if user.session is not None:
+        user.session.close()
+
+
+def heard_from(user):
+    """
+    push back a user's idle deadline, they have just sent a packet. The deadline of
+    a user connected to another worker is on that worker's wheel, it is told at most
+    once a tick
+    """
+    if IDLE_WHEEL is None or USERS.get(user.nick) is not user:
+        return
+    now = time.monotonic()
+    if user.worker is None:
+        IDLE_WHEEL.schedule(user, now + IDLE_TIMEOUT)
+        return
+    tick = int(now / IDLE_TICK)
+    if user.heard != tick:
+        user.heard = tick
+        publish(broker.HEARD, user.worker, user.nick)
+
+
+def expire_idle_users():
+    """disconnect the users whose idle deadline has passed"""
+    for user in IDLE_WHEEL.advance(time.monotonic()):
+        if USERS.get(user.nick) is not user:
+            continue
+        user.outbox.close()
+        drop_user(user.nick)
+        METRICS.idle_expired()
+        logger.info("user %s has timed out after %ss idle", user.nick, IDLE_TIMEOUT)
+        if user.session is not None:
+            user.session.close()
+
+
+def join_room(user, room):
+    """
+    add user to a room, keeping User.rooms and the ROOMS member index in step
+
+    :param user: the joining User
+    :param room: the room
+    :return: False when the room or the user was gone
+    """
+    if not STATE.join(user, room):
+        return False
+    publish(broker.JOIN, user.nick, room)
+    return True
+
+
+def leave_room(user, room):
+    """
+    remove user from a room, keeping User.rooms and the ROOMS member index in step
+
+    :param user: the leaving User
+    :param room: the room
+    :return: False when the room was gone
+    """
+    if not STATE.leave(user, room):
+        return False
+    publish(broker.LEAVE, user.nick, room)
+    return True
+
+
+def drop_user(nick, announce=True):
+    """
+    remove a user from USERS and from the members of every room they were in,
+    closing any kept-alive connection to their listener
+
+    :param nick: the user's nick
+    :param announce: False when the other workers already know, it was one of them that dropped the user.
+                     Otherwise they are told whichever worker the user is connected to
+    :return: the removed User or None
+    """
+    user = STATE.drop_user(nick)
+    if user is None:
+        return None
+    if user.worker is None:
+        if user.session is None and DIAL_BACKS is not None:
+            DIAL_BACKS.discard(user.address)
+        if IDLE_WHEEL is not None:
+            IDLE_WHEEL.cancel(user)
+    if announce:
+        publish(broker.DROP, nick)
+    return user
+
+
+def destroy_room(room):
+    """
+    remove a room and take it off its members' room lists
+
+    :param room: the room
+    :return: False when there was no such room
+    """
+    if not STATE.destroy_room(room):
+        return False
+    HISTORIES.pop(room, None)
+    ROOM_BUCKETS.pop(room, None)
+    return True
+
+
+def record_history(room, encoded):
+    """
+    keep a room message for replay to later joiners
+
+    :param room: the room
+    :param encoded: the message as fan-out encoded it, wire -> bytes
+    """
+    if not HISTORY_MESSAGES:
+        return
+    history = HISTORIES.get(room)
+    if history is None:
+        history = HISTORIES[room] = RoomHistory(HISTORY_MESSAGES, HISTORY_BYTES)
+    history.record(encoded)
+
+
+def log_message(packet, encoded):
+    """
+    append a delivered room or broadcast message to the MessageLog, if one is kept
+
+    :param packet: the delivered Packet
+    :param encoded: the packet as fan-out encoded it, wire -> bytes
+    """
+    if MESSAGE_LOG is None:
+        return
+    # either wire format will do, decode() tells them apart when reading back
+    data = next(iter(encoded.values())) if encoded else protocol.encode(packet)
+    MESSAGE_LOG.append(data)
+
+
+def open_message_log(directory):
+    """
+    start logging messages to directory, appending to what is there
+
+    :param directory: the log's directory, created if missing
+    """
+    global MESSAGE_LOG
+    MESSAGE_LOG = msglog.MessageLog(directory)
+    logger.info("logging messages to %s from sequence number %d", directory, MESSAGE_LOG.next_seq)
+
+
+def snapshot_path(worker):
+    """:return: the snapshot file of a worker, or of the only process when worker is None"""
+    if worker is None:
+        return SNAPSHOT_PATH
+    return "{}.worker-{}".format(SNAPSHOT_PATH, worker)
+
+
+def snapshot_state():
+    """:return: ROOMS and this process's dial-back users, as snapshot.save() takes them"""
+    users = [(user.nick, user.address[0], user.address[1], user.wire, tuple(user.rooms))
+             for user in list(USERS.values())
+             if user.session is None and user.worker is None]
+    return list(ROOMS), users
+
+
+def save_snapshot(rooms, users):
+    """
+    write a snapshot, see snapshot_state()
+
+    :param rooms: every room
+    :param users: the users to keep
+    """
+    started = time.perf_counter()
+    try:
+        snapshot.save(snapshot_path(WORKER_ID), rooms, users)
+    except OSError as e:
+        logger.warning("could not save a snapshot: %s", e)
+        return
+    logger.info("saved %d users and %d rooms in %.3fs", len(users), len(rooms), time.perf_counter() - started)
+
+
+def restore_snapshot():
+    """
+    bring back the rooms and dial-back users of the last run's snapshots. A worker
+    restores every worker's snapshot, the users saved by another worker stay theirs.
+    Users saved by workers past WORKERS, when fewer are run than before, are lost.
+    """
+    started = time.perf_counter()
+    workers = [None] if WORKER_ID is None else range(WORKERS)
+    # the collector would walk the growing heap over and over while it is built up
+    gc.disable()
+    try:
+        restored = _restore_snapshots(workers)
+    finally:
+        # restored users are long lived, later collections need not walk them
+        gc.freeze()
+        gc.enable()
+    logger.info("restored %d users and %d rooms in %.3fs", restored, len(ROOMS), time.perf_counter() - started)
+
+
+def _restore_snapshots(workers):
+    """:return: how many users were restored from the snapshots of workers"""
+    restored = 0
+    for worker in workers:
+        loaded = snapshot.load(snapshot_path(worker))
+        if loaded is None:
+            continue
+        rooms, users = loaded
+        pairs = []
+        for nick, host, port, wire, user_rooms in users:
+            user = User(nick, (host, port))
+            user.wire = wire
+            if worker == WORKER_ID:
+                user.outbox = Outbox(OUTBOX_SIZE, OUTBOX_POLICY)
+            else:
+                user.worker = worker
+            pairs.append((user, user_rooms))
+        # nothing is served yet, so the store is filled without its locks
+        for user in STATE.load(rooms, pairs):
+            # a restored user has a whole IDLE_TIMEOUT to be heard from
+            heard_from(user)
+        restored += len(users)
+    return restored
+
+
+def replay_history(user, room):
+    """
+    send a user who just joined a room its kept messages, as one write
+
+    :param user: the joining User
+    :param room: the room
+    """
+    history = HISTORIES.get(room)
+    if history is None or not len(history):
+        return
+    batch = history.replay(user.wire)
+    if user.worker is None:
+        enqueue(user, batch)
+    else:
+        publish(broker.DELIVER, user.worker, [user.nick], {user.wire: batch}, None)
+
+
+def publish(*event):
+    """
+    pass a state change on to the other workers, see broker.
+    Does nothing unless this is a worker of a multi-process server.
+    """
+    if BROKER is not None:
+        BROKER.send(event)
+
+
+def apply_event(event):
+    """
+    make a state change published by another worker, or deliver
+    to this worker's users what another worker fanned out
+
+    :param event: a broker event tuple
+    """
+    kind = event[0]
+    if kind == broker.DELIVER:
+        _, worker, nicks, encoded, room = event
+        for nick in nicks:
+            user = USERS.get(nick)
+            if user is not None and user.worker is None:
+                enqueue(user, encoded[user.wire])
+        if room is not None and room in ROOMS:
+            record_history(room, encoded)
+    elif kind == broker.HEARD:
+        user = USERS.get(event[2])
+        if user is not None and user.worker is None:
+            heard_from(user)
+    elif kind == broker.CONNECT:
+        _, worker, nick, address, wire = event
+        user = User(nick, address)
+        user.worker = worker
+        user.wire = wire
+        if not STATE.add_user(user):
+            logger.warning("user %s connected to workers %s and %s", nick, worker,
+                           getattr(USERS.get(nick), "worker", None))
+    elif kind == broker.DROP:
+        user = drop_user(event[1], announce=False)
+        if user is not None and user.worker is None:
+            # a legacy DISCONNECT taken by another worker, the user was ours
+            user.outbox.close()
+            if user.session is not None:
+                user.session.close()
+            logger.info("user %s has disconnected through another worker", user.nick)
+    elif kind == broker.CREATE:
+        STATE.create_room(event[1])
+    elif kind == broker.DESTROY:
+        destroy_room(event[1])
+    elif kind in (broker.JOIN, broker.LEAVE):
+        user = USERS.get(event[1])
+        if user is not None:
+            if kind == broker.JOIN:
+                STATE.join(user, event[2])
+            else:
+                STATE.leave(user, event[2])
+    elif kind == broker.GONE:
+        for nick, user in list(USERS.items()):
+            if user.worker == event[1]:
+                drop_user(nick, announce=False)
+        logger.warning("worker %s is gone, its users were dropped", event[1])
+
+
+def receive(event):
+    """BrokerLink callback, hands the event to the event loop when there is one"""
+    if EVENT_LOOP is not None:
+        EVENT_LOOP.call_soon_threadsafe(apply_event, event)
+    else:
+        apply_event(event)
+
+
 def disconnect(users):
     """This function sends Disconnect packets to users when the server is killed."""
     for nick, user in list(users.items()):
+        if user.worker is not None:
+            continue
+        data = protocol.encode(protocol.Disconnect(nick,
+                                                   status=Status.ERR,
+                                                   err="server shutting down"), user.wire)
+        if user.session is not None:
+            enqueue(user, data)
+            continue
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(user.address)
-            s.send(protocol.Disconnect(nick,
-                                       status=Status.ERR,
-                                       err="server shutting down").encode())
-            s.close()
+            DIAL_BACKS.send(user.address, data)
         except socket.error as e:
-            if e.errno == 111:  # connect err
+            if e.errno in DEAD_LISTENER:
                 remove_user(user.address)
 
 
@@ -55,10 +960,17 @@ def interrupt_handler(signal, frame):
     :param frame: current stack frame
     """
 
-    disconnect(USERS)
+    if SNAPSHOT_PATH is not None:
+        save_snapshot(*snapshot_state())
+        # dial-back users are restored from the snapshot, only sessions end
+        disconnect({nick: user for nick, user in list(USERS.items()) if user.session is not None})
+    else:
+        disconnect(USERS)
 
-    logging.info('Server turning off')
+    logger.info('Server turning off')
     SERVER_SOCKET.close()
+    if MESSAGE_LOG is not None:
+        MESSAGE_LOG.close()
 
     sys.exit(0)
 
@@ -71,119 +983,307 @@ def message(username, msg, room):
     # does user and room exist
     if username in USERS and room in ROOMS:
         # if user is in the room, then message room
-        if room in USERS[username].rooms:
-            logger.debug("{}".format(USERS))
-            addresses = []
-            for nick, user in list(USERS.items()):
-                if room in USERS[nick].rooms:
-                    addresses.append(user.address)
-
+        if username in ROOMS.get(room, ()):
             msg_packet = protocol.Message(username, msg, room, status=Status.OK)
 
-            sockets = append_sockets(addresses)
+            users = []
+            for nick in STATE.members(room):
+                user = USERS.get(nick)
+                if user is not None:
+                    users.append(user)
+
+            encoded = fan_out(users, msg_packet, room)
+            record_history(room, encoded)
+            log_message(msg_packet, encoded)
+
+
+def fan_out(users, packet, room=None):
+    """
+    queue a packet for users, it is pushed over sessions and dialed
+    back to the listeners of legacy users by each user's drainer
+
+    :param users: list of recipient Users
+    :param packet: the Packet to deliver
+    :param room: the room of a room message. The workers it is handed to keep it in the
+                 room's history from the same event. A worker none of whose users are in
+                 the room is not handed it, so its users who join later are not replayed it
+    :return: the packet as encoded for the recipients, wire -> bytes
+    """
+    started = METRICS.fan_out.start()
+    METRICS.fan_out_size.record(len(users))
+
+    # encoded once per wire format, every recipient is handed the same bytes
+    encoded = {}
+    remote = {}
+    for user in users:
+        data = encoded.get(user.wire)
+        if data is None:
+            data = encoded[user.wire] = protocol.encode(packet, user.wire)
+        if user.worker is not None:
+            remote.setdefault(user.worker, []).append(user.nick)
+        else:
+            enqueue(user, data)
+
+    # users connected to other workers are handed to their worker in one event each
+    for worker, nicks in remote.items():
+        publish(broker.DELIVER, worker, nicks, encoded, room)
+
+    METRICS.fan_out.stop(started)
+    return encoded
+
+
+def enqueue(user, data, response=False, start_compression=False):
+    """
+    queue an encoded packet in a user's Outbox and see that it gets drained
+
+    :param user: the recipient User
+    :param data: the encoded packet
+    :param response: True for a response to the user's own command
+    :param start_compression: see Outbox.put()
+    """
+    result = user.outbox.put(data, response, start_compression)
+    if result == START:
+        start_drain(user)
+    elif result == DROPPED:
+        METRICS.outbox_dropped()
+    elif result == OVERFLOW:
+        evict(user, metrics.OVERFLOW, "outbound queue full")
+
+
+def start_drain(user):
+    """
+    drain a user's Outbox. Session writes are tried right away without blocking,
+    only what a socket will not take yet, and dial-backs, are left to one of the
+    FAN_OUT_WORKERS drainers, so the sender never waits on a recipient
+    """
+    if EVENT_LOOP is not None:
+        if user.session is not None:
+            user.session.flush()
+        else:
+            EVENT_LOOP.create_task(drain_async(user))
+    elif user.session is None or not flush_nowait(user):
+        DRAINERS.submit(drain, user)
+
+
+def flush_nowait(user):
+    """
+    write a session's Outbox for as long as its socket takes the packets without blocking
 
-            for s in sockets:
-                with s.makefile('w') as wfile:
-                    wfile.write(msg_packet.__str__())
-                s.close()
+    :return: False if the rest needs a drainer that may block
+    """
+    while True:
+        data = user.outbox.take()
+        if data is None:
+            return True
+        try:
+            sent = user.session.send_nowait(data)
+        except socket.error:
+            evict(user, metrics.UNREACHABLE, "connection lost")
+            return True
+        if sent < len(data):
+            user.outbox.requeue(data[sent:])
+            return False
 
 
-def append_sockets(addresses):
-    sockets = []
-    for address in addresses:
+def drain(user):
+    """
+    write up to DRAIN_BATCH packets of a user's Outbox, each given DELIVERY_TIMEOUT,
+    then queue the rest behind the other users waiting for a drainer. The pool
+    keeps a drainer's exceptions to itself, an unexpected one evicts the user
+    rather than leave their Outbox waiting on a drain that has ended
+    """
+    try:
+        more = drain_batch(user)
+    except Exception:
+        logger.exception("could not deliver to user %s", user.nick)
+        evict(user, metrics.UNREACHABLE, "delivery failed")
+        return
+    if more:
+        DRAINERS.submit(drain, user)
+
+
+def drain_batch(user):
+    """:return: True when the Outbox still needs draining"""
+    timeout = DELIVERY_TIMEOUT or None
+    for _ in range(DRAIN_BATCH):
+        data = user.outbox.take()
+        if data is None:
+            return False
+        if user.session is not None:
+            try:
+                user.session.send(data, timeout)
+            except socket.timeout:
+                # part of a packet may be written, the rest of the stream cannot follow it
+                METRICS.delivery_timed_out()
+                evict(user, metrics.TIMEOUT, "delivery timed out")
+                return False
+            except socket.error:
+                evict(user, metrics.UNREACHABLE, "connection lost")
+                return False
+            continue
         try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(address)
-            sockets.append(s)
+            DIAL_BACKS.send(user.address, data)
+        except socket.timeout:
+            METRICS.delivery_timed_out()
         except socket.error as e:
-            if e.errno == 111:  # connect err
-                remove_user(address)
-    return sockets
+            METRICS.failed_dial_back()
+            if e.errno in DEAD_LISTENER:
+                evict(user, metrics.UNREACHABLE, "listener gone: {}".format(e))
+                return False
+    return True
+
+
+def write_buffers(sock, buffers):
+    """
+    write already encoded buffers to a socket with one vectored send,
+    falling back to sendall only for whatever the kernel did not take
+
+    :param sock: a connected socket
+    :param buffers: list of bytes
+    """
+    sent = sock.sendmsg(buffers)
+    if sent < sum(len(b) for b in buffers):
+        sock.sendall(b"".join(buffers)[sent:])
+
+
+async def drain_async(user):
+    """
+    dial back up to DRAIN_BATCH packets of a legacy user's Outbox from the asyncio
+    engine, then queue the rest behind the other users waiting for one of the
+    FAN_OUT_WORKERS slots
+    """
+    async with DRAIN_SLOTS:
+        for _ in range(DRAIN_BATCH):
+            data = user.outbox.take()
+            if data is None:
+                return
+            try:
+                await DIAL_BACKS.send_async(user.address, data)
+            except socket.timeout:
+                METRICS.delivery_timed_out()
+            except socket.error as e:
+                METRICS.failed_dial_back()
+                if e.errno in DEAD_LISTENER:
+                    evict(user, metrics.UNREACHABLE, "listener gone: {}".format(e))
+                    return
+            except Exception:
+                logger.exception("could not deliver to user %s", user.nick)
+                evict(user, metrics.UNREACHABLE, "delivery failed")
+                return
+    EVENT_LOOP.create_task(drain_async(user))
 
 
 def remove_user(address):
-    for nick, user in list(USERS.items()):
-        if user.address == address:
-            USERS.pop(nick)
+    """
+    remove the user listening on address
+
+    :param address: the user's listener address
+    """
+    nick = ADDRESSES.get(address)
+    if nick is not None:
+        drop_user(nick)
 
 
 def priv_message(username, msg, send_to):
     # does user and send_to user exist
-    if username in USERS and send_to in USERS:
-        try:
-            msg_packet = protocol.PrivateMessage(username, msg, send_to, status=Status.OK)
+    recipient = USERS.get(send_to)
+    if username in USERS and recipient is not None:
+        msg_packet = protocol.PrivateMessage(username, msg, send_to, status=Status.OK)
+        fan_out([recipient], msg_packet)
 
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(USERS[send_to].address)
 
-            with s.makefile('w') as wfile:
-                wfile.write(msg_packet.__str__())
-            s.close()
-        except socket.error as e:
-            if e.errno == 111:  # connect err
-                remove_user(USERS[send_to].address)
+def broadc_message(username, msg, rooms):
+    """
+    deliver a broadcast once to every member of any of rooms. Each copy lists
+    only the rooms of the recipient's it was sent to, recipients with the
+    same rooms in common share one encoded copy.
+    """
+    for matched, users in find_users_broadcast(rooms).items():
+        fan_out(users, protocol.Broadcast(username, msg, matched, status=Status.OK))
 
+    log_message(protocol.Broadcast(username, msg, rooms, status=Status.OK), {})
 
-def broadc_message(username, msg, rooms):
-    users = find_users_broadcast(rooms)
 
-    bmsg_packet = protocol.Broadcast(username, msg, rooms, status=Status.OK)
+def find_users_broadcast(rooms):
+    """
+    the union of the rooms' member sets, so each recipient is found once
+    however many of the rooms they are in
 
-    sockets = []
-    for user in users:
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect(user.address)
-            sockets.append(s)
-        except socket.error as e:
-            if e.errno == 111:  # connect err
-                remove_user(user.address)
+    :param rooms: the rooms a broadcast goes to
+    :return: {(matched room, ...): [User, ...]}, the recipients grouped by the rooms of theirs that matched
+    """
+    targets = set(rooms)
+    groups = {}
+    for nick in set().union(*[STATE.members(room) for room in targets]):
+        user = USERS.get(nick)
+        if user is None:
+            continue
+        matched = tuple([room for room in user.rooms if room in targets])
+        # they may have left the rooms since
+        if not matched:
+            continue
+        users = groups.get(matched)
+        if users is None:
+            groups[matched] = [user]
+        else:
+            users.append(user)
+    return groups
 
-    for s in sockets:
-        with s.makefile("w") as wfile:
-            wfile.write(bmsg_packet.__str__())
-        s.close()
 
+class PacketHandler(object):
+    """
+    The packet handling logic shared by the server engines. An engine mixes this in
+    and provides client_address, session, _write() and _open_session().
+    """
 
-def find_users_broadcast(rooms):
-    users = []
-    for room in rooms:
-        if room in ROOMS:
-            for nick, user in list(USERS.items()):
-                append_user(room, user, users)
-    return users
+    def _handle_frame(self, data):
+        """
+        decode and handle one packet, then write the response in the
+        same wire format the packet came in
 
+        :param data: the bytes of one packet
+        """
+        self.data = data
+        self.wire = protocol.wire_of(data)
 
-def append_user(room, user, users):
-    if room in user.rooms and user not in users:
-        users.append(user)
+        logger.debug("%s", self.client_address)
 
+        # decode packet
+        started = METRICS.decode.start()
+        packet = protocol.decode(self.data)
+        METRICS.decode.stop(started)
+        METRICS.request(packet.opcode)
+        logger.debug("%s sent packet %r", self.client_address[0], packet)
 
-class IRCHandler(socketserver.StreamRequestHandler):
-    """This is the IRC handler class used by the Threaded socket-server to handle requests"""
+        # anything a user sends shows they are alive, a session is always its user's
+        sender = self.session.user if self.session is not None else USERS.get(getattr(packet, "username", None))
+        if sender is not None:
+            heard_from(sender)
 
-    def handle(self):
-        """ handling request main logic """
-        try:
-            # read data from socket
-            self.data = self.rfile.readline().strip()
+        # handle packet
+        started = METRICS.handle.start()
+        response = self._handle_packet(packet)
+        METRICS.handle.stop(started)
 
-            logger.debug(self.request.getpeername())
+        # O(users) to build, so only when debug output is going somewhere
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("connected USERS - %s", " ".join(USERS))
+            logger.debug("rooms available - %s", ROOMS)
 
-            # decode packet
-            packet = protocol.decode(self.data)
-            logger.debug("{} sent packet {}".format(self.client_address[0], packet.encode()))
+        # write response
+        self._write(protocol.encode(response, self.wire))
 
-            # handle packet
-            response = self._handle_packet(packet)
+    def _write(self, data):
+        """write an encoded packet back to the client"""
+        raise NotImplementedError
 
-            logger.debug("connected USERS - {}".format(USERS.__str__()))
-            logger.debug("rooms available - {}".format(ROOMS.__str__()))
+    def _open_session(self, user):
+        """
+        keep this connection open as user's session
 
-            # write response
-            self.wfile.write(response.encode())
-        except Disconnection:
-            return
+        :return: a Session for the connection
+        """
+        raise NotImplementedError
 
     def _handle_packet(self, packet):
         """
@@ -203,8 +1303,17 @@ class IRCHandler(socketserver.StreamRequestHandler):
             Opcode.MSG: self._handle_message,
             Opcode.PRIVATE_MSG: self._handle_private_message,
             Opcode.BROADCAST_MSG: self._handle_broadcast_message,
+            Opcode.STATS: self._handle_stats,
+            Opcode.PING: self._handle_ping,
         }
 
+        # refuse a flood before it costs any fan-out
+        if packet.opcode in RATE_LIMITED_OPCODES and (USER_RATE > 0 or ROOM_RATE > 0):
+            wait = check_rate_limits(packet)
+            if wait:
+                METRICS.rate_limit()
+                return PacketHandler._error(packet, protocol.rate_limited(wait))
+
         return self.handle_d[packet.opcode](packet)
 
     def _handle_connection(self, connect):
@@ -216,20 +1325,49 @@ class IRCHandler(socketserver.StreamRequestHandler):
         """
         if connect.username not in USERS:
             # create new user and add to USERS dictionary
-            new_user = User(connect.username, self.connection.getpeername())
+            new_user = User(connect.username, self.client_address)
             port = new_user.address[1] + 100
             new_user.address = (new_user.address[0], port)
-            logger.debug("{} {}".format(new_user.address[0], new_user.address[1]))
-            USERS[new_user.nick] = new_user
+            logger.debug("%s %s", new_user.address[0], new_user.address[1])
+
+            # deliveries use the binary framing if asked for, tell the client what it got
+            if connect.config.get("wire") == str(protocol.WIRE_BINARY):
+                new_user.wire = protocol.WIRE_BINARY
+            connect.config = dict(connect.config, wire=new_user.wire)
+            new_user.outbox = Outbox(OUTBOX_SIZE, OUTBOX_POLICY)
+
+            # session mode keeps this connection, legacy mode dials back to the listener
+            if connect.config.get("mode") == protocol.SESSION and self.session is None:
+                new_user.session = self._open_session(new_user)
+
+            # another connection may have taken the nick since it was checked
+            if not STATE.add_user(new_user):
+                return PacketHandler._error(connect,
+                                         "user already exists. choose another name")
+            if new_user.session is not None:
+                self.session = new_user.session
+            heard_from(new_user)
+            if IDLE_WHEEL is not None:
+                connect.config = dict(connect.config, idle=IDLE_TIMEOUT)
+
+            # a session may compress the rest of the connection, the response says if it does
+            if "compress" in connect.config:
+                self.compress = (connect.config["compress"] == protocol.COMPRESS_ZLIB
+                                 and new_user.session is not None and COMPRESSION_LEVEL > 0)
+                connect.config = dict(connect.config, compress=protocol.COMPRESS_ZLIB
+                                      if self.compress else protocol.COMPRESS_NONE)
+                if self.compress:
+                    self.decoder.inflate()
+            publish(broker.CONNECT, WORKER_ID, new_user.nick, new_user.address, new_user.wire)
 
             # log new user
-            logger.info("new user {} has connected".format(new_user.nick))
+            logger.info("new user %s has connected", new_user.nick)
 
             # set connect status to OK
             connect.status = Status.OK
             return connect
         else:
-            return IRCHandler._error(connect,
+            return PacketHandler._error(connect,
                                      "user already exists. choose another name")
 
     def _handle_disconnect(self, disconnect):
@@ -242,15 +1380,15 @@ class IRCHandler(socketserver.StreamRequestHandler):
         if disconnect.username in USERS:
             # send message of disconnect to rooms
             # remove from USERS
-            USERS.pop(disconnect.username)
-            logger.info("user {} has disconnected".format(disconnect.username))
+            drop_user(disconnect.username)
+            logger.info("user %s has disconnected", disconnect.username)
             # send OK response
             disconnect.status = Status.OK
-            self.wfile.write(disconnect.encode())
+            self._write(protocol.encode(disconnect, self.wire))
 
             raise Disconnection(disconnect)
         else:
-            return IRCHandler._error(disconnect,
+            return PacketHandler._error(disconnect,
                                      "username specified does not exist in server.")
 
     @staticmethod
@@ -261,17 +1399,17 @@ class IRCHandler(socketserver.StreamRequestHandler):
         :param create: Create packet
         :return: return Create packet with updated status
         """
-        if create.room not in ROOMS:
-            # create the room
-            ROOMS.append(create.room)
+        if STATE.create_room(create.room):
+            # the room is created, tell the other workers
+            publish(broker.CREATE, create.room)
 
             # log room creation
-            logger.info("room {} has now been created.".format(create.room))
+            logger.info("room %s has now been created.", create.room)
 
             create.status = Status.OK
             return create
         else:
-            return IRCHandler._error(create,
+            return PacketHandler._error(create,
                                      "room already exists, use /join to join the room.")
 
     @staticmethod
@@ -282,17 +1420,17 @@ class IRCHandler(socketserver.StreamRequestHandler):
         :param destroy: Destroy packet
         :return: return Destroy packet with updated status
         """
-        if destroy.room in ROOMS:
-            # remove the room
-            ROOMS.remove(destroy.room)
+        # remove the room and take it off its members' room lists
+        if destroy_room(destroy.room):
+            publish(broker.DESTROY, destroy.room)
 
             # log room removal
-            logger.info("room {} has now been removed.".format(destroy.room))
+            logger.info("room %s has now been removed.", destroy.room)
 
             destroy.status = Status.OK
             return destroy
         else:
-            return IRCHandler._error(destroy,
+            return PacketHandler._error(destroy,
                                      "the room specified does not exist")
 
     @staticmethod
@@ -302,20 +1440,23 @@ class IRCHandler(socketserver.StreamRequestHandler):
         :param join: Join packet
         :return: return Join packet with updated status
         """
-        if join.username in USERS and join.room in ROOMS:
-            # join room in users group
-            USERS[join.username].join_room(join.room)
+        user = USERS.get(join.username)
+        # join room in users group
+        joining = user is not None and join.room not in user.rooms
+        if user is not None and join_room(user, join.room):
+            # what was said before they came in, then the join notice
+            if joining:
+                replay_history(user, join.room)
 
             # log join
-            logger.info("user {} has joined room {}"
-                        .format(join.username, join.room))
+            logger.info("user %s has joined room %s", join.username, join.room)
             # message room that user joined
             message(join.username, "user {} has joined room {}".format(join.username, join.room), join.room)
             # return ok
             join.status = Status.OK
             return join
         else:
-            return IRCHandler._error(join, "was not able to join the room")
+            return PacketHandler._error(join, "was not able to join the room")
 
     @staticmethod
     def _handle_leave(leave):
@@ -325,13 +1466,11 @@ class IRCHandler(socketserver.StreamRequestHandler):
         :param leave: Leave packet
         :return: return Leave packet with updated status
         """
-        if leave.username in USERS and leave.room in ROOMS:
-            # leave room in users group
-            USERS[leave.username].leave_room(leave.room)
-
+        user = USERS.get(leave.username)
+        # leave room in users group
+        if user is not None and leave_room(user, leave.room):
             # log leave
-            logger.info("user {} has left room {}"
-                        .format(leave.username, leave.room))
+            logger.info("user %s has left room %s", leave.username, leave.room)
 
             # message room that user joined
             message(leave.username, "user {} has left room {}"
@@ -340,7 +1479,7 @@ class IRCHandler(socketserver.StreamRequestHandler):
             leave.status = Status.OK
             return leave
         else:
-            return IRCHandler._error(leave, "unable to leave room")
+            return PacketHandler._error(leave, "unable to leave room")
 
     @staticmethod
     def _handle_list(_list):
@@ -356,13 +1495,13 @@ class IRCHandler(socketserver.StreamRequestHandler):
             _list.status = Status.OK
             return _list
         elif _list.room in ROOMS:
-            members = IRCHandler.find_members(_list)
+            members = PacketHandler.find_members(_list)
             _list.response = ' '.join(members)
             _list.length = len(members)
             _list.status = Status.OK
             return _list
         else:
-            return IRCHandler._error(_list, "error with list")
+            return PacketHandler._error(_list, "error with list")
 
     @staticmethod
     def find_members(_list):
@@ -372,11 +1511,7 @@ class IRCHandler(socketserver.StreamRequestHandler):
         :param _list: List packet
         :return: a list contain memberships of room
         """
-        members = []
-        for nick, user in USERS.items():
-            if _list.room in user.rooms:
-                members.append(nick)
-        return members
+        return list(STATE.members(_list.room))
 
     @staticmethod
     def _handle_message(msg):
@@ -388,13 +1523,11 @@ class IRCHandler(socketserver.StreamRequestHandler):
         """
         if msg.username in USERS and msg.room in ROOMS:
             message(msg.username, msg.message, msg.room)
-            logger.info("{} sent message {} to room {}".format(
-                msg.username, msg.message, msg.room,
-            ))
+            logger.info("%s sent message %s to room %s", msg.username, msg.message, msg.room)
             msg.status = Status.OK
             return msg
         else:
-            return IRCHandler._error(msg, "could not send message")
+            return PacketHandler._error(msg, "could not send message")
 
     @staticmethod
     def _handle_private_message(private_message):
@@ -407,13 +1540,11 @@ class IRCHandler(socketserver.StreamRequestHandler):
         pmsg = private_message
         if pmsg.username in USERS and pmsg.send_to in USERS:
             priv_message(pmsg.username, pmsg.message, pmsg.send_to)
-            logger.info("{} sent message {} to user {}".format(
-                pmsg.username, pmsg.message, pmsg.send_to,
-            ))
+            logger.info("%s sent message %s to user %s", pmsg.username, pmsg.message, pmsg.send_to)
             pmsg.status = Status.OK
             return pmsg
         else:
-            return IRCHandler._error(pmsg, "could not send private smessage")
+            return PacketHandler._error(pmsg, "could not send private smessage")
 
     def _handle_broadcast_message(self, broadcast_message):
         """
@@ -423,18 +1554,49 @@ class IRCHandler(socketserver.StreamRequestHandler):
         :return: packet with updated information
         """
         bmsg = broadcast_message
-        if bmsg.username in USERS:
-            broadc_message(bmsg.username, bmsg.message, bmsg.rooms.split(" "))
-            logger.info(
-                "{} send broadcast message {} to rooms {}".format(
-                    bmsg.username,
-                    bmsg.message,
-                    bmsg.rooms)
-            )
+        user = USERS.get(bmsg.username)
+        if user is None:
+            return PacketHandler._error(bmsg, "error with sending the broadcast message")
+        elif not all(room in ROOMS and room in user.rooms for room in bmsg.rooms):
+            return PacketHandler._error(bmsg, "can only broadcast to rooms you have joined")
+        else:
+            broadc_message(bmsg.username, bmsg.message, bmsg.rooms)
+            logger.info("%s send broadcast message %s to rooms %s", bmsg.username, bmsg.message, bmsg.rooms)
             bmsg.status = Status.OK
             return bmsg
+
+    @staticmethod
+    def _handle_stats(stats):
+        """
+        reports the server's live counters
+
+        :param stats: Stats packet
+        :return: Stats packet with the counters as response
+        """
+        stats.response = METRICS.report(USERS, ROOMS)
+        histories = list(HISTORIES.values())
+        stats.response += ["history.rooms={}".format(len(histories)),
+                           "history.messages={}".format(sum(len(history) for history in histories)),
+                           "history.bytes={}".format(sum(history.bytes for history in histories))]
+        if WORKER_ID is not None:
+            stats.response.insert(0, "worker={}".format(WORKER_ID))
+        stats.status = Status.OK
+        return stats
+
+    @staticmethod
+    def _handle_ping(ping):
+        """
+        answers a client's heartbeat, _handle_frame() has already pushed back their idle deadline
+
+        :param ping: Ping packet
+        :return: a Pong packet, ERR when the user is not connected, they may have timed out
+        """
+        pong = protocol.Pong(ping.username)
+        if ping.username in USERS:
+            pong.status = Status.OK
+            return pong
         else:
-            return IRCHandler._error(bmsg, "error with sending the broadcast message")
+            return PacketHandler._error(pong, "username specified does not exist in server.")
 
     @staticmethod
     def _error(packet, error_message):
@@ -450,8 +1612,337 @@ class IRCHandler(socketserver.StreamRequestHandler):
         return packet
 
 
-if __name__ == '__main__':
-    server = socketserver.ThreadingTCPServer((HOST, PORT), IRCHandler)
+class IRCHandler(PacketHandler, socketserver.StreamRequestHandler):
+    """This is the IRC handler class used by the Threaded socket-server to handle requests"""
+
+    def handle(self):
+        """ handling request main logic """
+        self.session = None
+        self.compress = False
+        self.decoder = protocol.StreamDecoder(MAX_FRAME_SIZE)
+        try:
+            # read data from socket, a burst of pipelined packets is handled from one recv
+            while True:
+                data = self.request.recv(RECV_SIZE)
+                if not data:
+                    break
+                for frame in self.decoder.feed(data):
+                    self._handle_frame(frame)
+
+                    # legacy connections carry a single packet, sessions
+                    # keep reading commands until the client hangs up
+                    if self.session is None:
+                        return
+        except Disconnection:
+            return
+        except protocol.FrameError as e:
+            logger.warning("%s closed for sending a bad frame: %s", self.client_address[0], e)
+        except socket.error as e:
+            logger.debug("%s connection error %s", self.client_address[0], e)
+        except Exception:
+            logger.exception("%s sent a bad packet", self.client_address[0])
+        finally:
+            if self.session is not None:
+                end_session(self.session)
+
+    def _write(self, data):
+        """write to the client, through its Outbox once it has a session"""
+        if self.session is not None:
+            # the response to a CONNECT that asked for compression turns it on
+            enqueue(self.session.user, data, response=True, start_compression=self.compress)
+            self.compress = False
+        else:
+            self.wfile.write(data)
+
+    def _open_session(self, user):
+        return Session(self.connection, user)
+
+
+class IRCServer(socketserver.ThreadingTCPServer):
+    """the thread per connection engine"""
+    allow_reuse_address = True
+    # session handlers block on their clients, don't let them hold up shutdown
+    daemon_threads = True
+
+    def server_bind(self):
+        # the workers of a multi-process server all listen on the same port
+        if WORKER_ID is not None:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+
+class AsyncIRCHandler(PacketHandler, asyncio.Protocol):
+    """
+    The asyncio engine's connection handler. Every connection is served on the one
+    event loop, fan-out writes go to transport buffers instead of blocking a thread.
+    """
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.client_address = transport.get_extra_info("peername")
+        self.session = None
+        self.compress = False
+        self.decoder = protocol.StreamDecoder(MAX_FRAME_SIZE)
+
+    def data_received(self, data):
+        try:
+            for frame in self.decoder.feed(data):
+                self._handle_frame(frame)
+
+                # legacy connections carry a single packet
+                if self.session is None:
+                    self.transport.close()
+                    return
+        except Disconnection:
+            self.transport.close()
+        except Exception:
+            logger.exception("%s sent a bad packet", self.client_address[0])
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        if self.session is not None:
+            end_session(self.session)
+
+    def pause_writing(self):
+        if self.session is not None:
+            self.session.pause()
+
+    def resume_writing(self):
+        if self.session is not None:
+            self.session.resume()
+
+    def _write(self, data):
+        if self.session is not None:
+            enqueue(self.session.user, data, response=True, start_compression=self.compress)
+            self.compress = False
+        else:
+            self.transport.write(data)
+
+    def _open_session(self, user):
+        return AsyncSession(self.transport, user, asyncio.get_running_loop())
+
+
+def reap_dial_backs():
+    """close idle dial-back connections every so often, runs on its own thread"""
+    while True:
+        time.sleep(DIAL_BACK_IDLE / 2)
+        DIAL_BACKS.reap()
+
+
+def reap_dial_backs_async():
+    """close idle dial-back connections every so often, scheduled on the event loop"""
+    DIAL_BACKS.reap()
+    EVENT_LOOP.call_later(DIAL_BACK_IDLE / 2, reap_dial_backs_async)
+
+
+def expire_idle_users_loop():
+    """disconnect idle users every IDLE_TICK seconds, runs on its own thread"""
+    while True:
+        time.sleep(IDLE_TICK)
+        expire_idle_users()
+
+
+def expire_idle_users_async():
+    """disconnect idle users every IDLE_TICK seconds, scheduled on the event loop"""
+    expire_idle_users()
+    EVENT_LOOP.call_later(IDLE_TICK, expire_idle_users_async)
+
+
+def save_snapshots():
+    """save a snapshot every SNAPSHOT_INTERVAL seconds, runs on its own thread"""
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        save_snapshot(*snapshot_state())
+
+
+def save_snapshots_async():
+    """save a snapshot every SNAPSHOT_INTERVAL seconds, the state is copied on the event loop"""
+    EVENT_LOOP.run_in_executor(None, save_snapshot, *snapshot_state())
+    EVENT_LOOP.call_later(SNAPSHOT_INTERVAL, save_snapshots_async)
+
+
+def serve_threads():
+    """serve with one thread per connection"""
+    global SERVER_SOCKET, DIAL_BACKS, IDLE_WHEEL, DRAINERS
+    DIAL_BACKS = DialBackPool(DIAL_BACK_IDLE)
+    DRAINERS = concurrent.futures.ThreadPoolExecutor(FAN_OUT_WORKERS, thread_name_prefix="drain")
+    threading.Thread(target=reap_dial_backs, daemon=True).start()
+    if IDLE_TIMEOUT > 0:
+        IDLE_WHEEL = timerwheel.TimerWheel(IDLE_TICK, IDLE_TIMEOUT, time.monotonic())
+        threading.Thread(target=expire_idle_users_loop, daemon=True).start()
+    if SNAPSHOT_PATH is not None:
+        restore_snapshot()
+        if SNAPSHOT_INTERVAL > 0:
+            threading.Thread(target=save_snapshots, daemon=True).start()
+    server = IRCServer((HOST, PORT), IRCHandler)
     SERVER_SOCKET = server.socket
     print("[*] server is now running on {} : {}".format(HOST, PORT))
     server.serve_forever()
+
+
+def serve_asyncio():
+    """serve every connection from a single asyncio event loop"""
+    global SERVER_SOCKET, EVENT_LOOP, DIAL_BACKS, IDLE_WHEEL, DRAIN_SLOTS
+    SERVER_SOCKET = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    SERVER_SOCKET.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if WORKER_ID is not None:
+        SERVER_SOCKET.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    SERVER_SOCKET.bind((HOST, PORT))
+
+    EVENT_LOOP = asyncio.new_event_loop()
+    asyncio.set_event_loop(EVENT_LOOP)
+    DIAL_BACKS = AsyncDialBackPool(DIAL_BACK_IDLE)
+    DRAIN_SLOTS = asyncio.Semaphore(FAN_OUT_WORKERS)
+    reap_dial_backs_async()
+    if IDLE_TIMEOUT > 0:
+        IDLE_WHEEL = timerwheel.TimerWheel(IDLE_TICK, IDLE_TIMEOUT, time.monotonic())
+        EVENT_LOOP.call_later(IDLE_TICK, expire_idle_users_async)
+    if SNAPSHOT_PATH is not None:
+        restore_snapshot()
+        if SNAPSHOT_INTERVAL > 0:
+            EVENT_LOOP.call_later(SNAPSHOT_INTERVAL, save_snapshots_async)
+    EVENT_LOOP.run_until_complete(
+        EVENT_LOOP.create_server(AsyncIRCHandler, sock=SERVER_SOCKET, backlog=1024))
+    print("[*] server is now running on {} : {} (asyncio)".format(HOST, PORT))
+    EVENT_LOOP.run_forever()
+
+
+ENGINES = {
+    "threads": serve_threads,
+    "asyncio": serve_asyncio,
+}
+
+
+def run_worker(engine, worker, path):
+    """
+    the main function of a worker process, serves with engine after linking up with the broker
+
+    :param engine: an ENGINES key
+    :param worker: the worker's number
+    :param path: the broker's Unix socket
+    """
+    global WORKER_ID, BROKER
+    logsink.after_fork()
+    WORKER_ID = worker
+    BROKER = broker.BrokerLink(path, worker, receive)
+    if MESSAGE_LOG_DIR is not None:
+        # each worker logs the messages its own users send
+        open_message_log(os.path.join(MESSAGE_LOG_DIR, "worker-{}".format(worker)))
+    try:
+        ENGINES[engine]()
+    finally:
+        # a multiprocessing child skips exit handlers
+        logsink.shutdown()
+
+
+def serve_workers(engine, workers):
+    """
+    fork workers processes that all accept connections on HOST:PORT with
+    SO_REUSEPORT, serving with engine and kept in step by a broker process.
+    A message from a user on one worker reaches room members on the others.
+
+    :param engine: an ENGINES key
+    :param workers: how many worker processes to run
+    """
+    path = os.path.join(tempfile.mkdtemp(prefix="irc-broker-"), "broker.sock")
+    listener = broker.listen(path)
+
+    context = multiprocessing.get_context("fork")
+    relay = context.Process(target=broker.run, args=(listener, workers), name="broker")
+    processes = [context.Process(target=run_worker, args=(engine, i, path), name="worker-{}".format(i))
+                 for i in range(workers)]
+    relay.start()
+    for process in processes:
+        process.start()
+
+    def stop(signum, frame):
+        """interrupt the workers, which disconnect their users, then the broker"""
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        for process in processes:
+            process.join(5)
+        relay.terminate()
+        listener.close()
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    print("[*] {} workers serving on {} : {}".format(workers, HOST, PORT))
+    for process in processes:
+        process.join()
+    stop(None, None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="IRC server")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="threads",
+                        help="threads: a thread per connection, "
+                             "asyncio: all connections on one event loop")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="run this many worker processes sharing the port with SO_REUSEPORT, "
+                             "0 serves from this process")
+    parser.add_argument("--host", default=HOST, help="address to listen on")
+    parser.add_argument("--port", type=int, default=PORT, help="port to listen on")
+    parser.add_argument("--max-frame", type=int, default=MAX_FRAME_SIZE,
+                        help="largest packet in bytes a client may send")
+    parser.add_argument("--history", type=int, default=HISTORY_MESSAGES,
+                        help="messages kept per room and replayed on JOIN, 0 keeps none")
+    parser.add_argument("--history-bytes", type=int, default=HISTORY_BYTES,
+                        help="encoded bytes kept per room")
+    parser.add_argument("--message-log", metavar="DIRECTORY", default=MESSAGE_LOG_DIR,
+                        help="keep a durable log of room and broadcast messages in DIRECTORY, "
+                             "read it back with msglog.py")
+    parser.add_argument("--snapshot", metavar="FILE", default=SNAPSHOT_PATH,
+                        help="save users and rooms to FILE at shutdown and restore them at startup, "
+                             "dial-back users then stay connected across a restart")
+    parser.add_argument("--snapshot-interval", type=float, default=SNAPSHOT_INTERVAL,
+                        help="seconds between snapshots while running, 0 saves only at shutdown")
+    parser.add_argument("--dial-back-idle", type=float, default=DIAL_BACK_IDLE,
+                        help="seconds an unused dial-back connection is kept open")
+    parser.add_argument("--compression-level", type=int, choices=range(10), default=COMPRESSION_LEVEL,
+                        help="zlib level for sessions that ask for compression, 0 refuses them")
+    parser.add_argument("--fan-out-workers", type=int, default=FAN_OUT_WORKERS,
+                        help="recipients written to at once by drainers that may block")
+    parser.add_argument("--delivery-timeout", type=float, default=DELIVERY_TIMEOUT,
+                        help="seconds one delivery may take, a session that times out is disconnected, "
+                             "0 waits as long as it takes")
+    parser.add_argument("--outbox-size", type=int, default=OUTBOX_SIZE,
+                        help="packets queued for a slow recipient before --outbox-policy applies")
+    parser.add_argument("--outbox-policy", choices=OUTBOX_POLICIES, default=OUTBOX_POLICY,
+                        help="what to do when a recipient's queue is full")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT,
+                        help="seconds a user may send nothing, not even a PING, before being disconnected, 0 never")
+    parser.add_argument("--user-rate", type=float, default=USER_RATE,
+                        help="messages a second each user may send, 0 for no limit")
+    parser.add_argument("--user-burst", type=int, default=USER_BURST,
+                        help="messages a user may send at once before --user-rate applies")
+    parser.add_argument("--room-rate", type=float, default=ROOM_RATE,
+                        help="messages a second each room may receive, 0 for no limit")
+    parser.add_argument("--room-burst", type=int, default=ROOM_BURST,
+                        help="messages a room may receive at once before --room-rate applies")
+    parser.add_argument("--log-level", choices=logsink.LEVEL_NAMES, default="INFO",
+                        help="initial log level, SIGUSR1/SIGUSR2 step it down/up while running")
+    parser.add_argument("--log-format", choices=logsink.FORMATS, default=logsink.STRUCTURED)
+    args = parser.parse_args()
+    logsink.configure(logger, args.log_level, args.log_format)
+    HOST, PORT = args.host, args.port
+    MAX_FRAME_SIZE = args.max_frame
+    COMPRESSION_LEVEL = args.compression_level
+    OUTBOX_SIZE, OUTBOX_POLICY = args.outbox_size, args.outbox_policy
+    USER_RATE, USER_BURST = args.user_rate, args.user_burst
+    IDLE_TIMEOUT = args.idle_timeout
+    ROOM_RATE, ROOM_BURST = args.room_rate, args.room_burst
+    DIAL_BACK_IDLE = args.dial_back_idle
+    FAN_OUT_WORKERS, DELIVERY_TIMEOUT = args.fan_out_workers, args.delivery_timeout
+    HISTORY_MESSAGES, HISTORY_BYTES = args.history, args.history_bytes
+    MESSAGE_LOG_DIR = args.message_log
+    SNAPSHOT_PATH, SNAPSHOT_INTERVAL = args.snapshot, args.snapshot_interval
+    WORKERS = args.workers
+    if args.workers:
+        serve_workers(args.engine, args.workers)
+    else:
+        if MESSAGE_LOG_DIR is not None:
+            open_message_log(MESSAGE_LOG_DIR)
+        ENGINES[args.engine]()
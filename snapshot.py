@@ -0,0 +1,51 @@
+"""
+Snapshot module - saves the server's users and rooms so a restart keeps them.
+
+A snapshot holds every room and, for each user reached by dial-back, their
+nick, listener address, wire format and rooms. Session users are left out,
+their connection does not outlive the server. Restoring a snapshot brings
+the dial-back users back as if they had never left: deliveries keep going
+to their listeners and none of them has to CONNECT, CREATE or JOIN again.
+
+Snapshots are marshalled tuples of strings and ints, the cheapest format
+Python writes and reads back, and are written to a temporary file that
+replaces the old snapshot only once it is complete and synced.
+"""
+
+import marshal
+import os
+
+# bumped whenever the layout below changes, older snapshots are then ignored
+VERSION = 1
+
+
+def save(path, rooms, users):
+    """
+    write a snapshot, atomically replacing any snapshot at path
+
+    :param path: the snapshot file
+    :param rooms: every room name
+    :param users: (nick, host, port, wire, rooms) for each user to keep
+    """
+    data = marshal.dumps((VERSION, tuple(rooms), tuple(users)))
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+
+
+def load(path):
+    """
+    :param path: the snapshot file
+    :return: (rooms, users) as given to save(), or None when there is no usable snapshot
+    """
+    try:
+        with open(path, "rb") as f:
+            version, rooms, users = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if version != VERSION:
+        return None
+    return rooms, users
@@ -0,0 +1,214 @@
+"""
+State module - the server's users, rooms and room memberships.
+
+Handler threads read and change the same users and rooms, so every change
+goes through a StateStore and is made under a lock:
+
+    lock                 adding and removing users and rooms. CONNECT, DISCONNECT,
+                         CREATE and DESTROY are rare next to messages
+    room_locks[room]     the room's member set and the room's entry in each
+                         member's User.rooms, so joins and leaves, and fan-out
+                         reading members, only ever wait on the same room
+
+The dicts themselves are for reading. A single lookup, nick in users or
+users.get(nick), needs no lock; anything that iterates members does it over
+the copy members() takes under the room lock.
+"""
+
+import sys
+import threading
+
+
+class StateStore(object):
+    """
+    users maps each nick to their User, rooms maps each room to the set of
+    nicks in it and addresses maps the listener address of each user
+    connected to this process back to their nick.
+    """
+
+    def __init__(self):
+        self.users = {}
+        self.rooms = {}
+        self.addresses = {}
+        self.room_locks = {}
+        self.lock = threading.Lock()
+
+    def add_user(self, user):
+        """
+        :param user: a User, indexed by address unless they are connected to another worker
+        :return: False, and nothing is added, when the nick is taken
+        """
+        with self.lock:
+            if user.nick in self.users:
+                return False
+            self.users[user.nick] = user
+            if user.worker is None:
+                self.addresses[user.address] = user.nick
+            return True
+
+    def drop_user(self, nick):
+        """
+        remove a user and take them out of the members of every room they were in
+
+        :param nick: the user's nick
+        :return: the removed User or None
+        """
+        with self.lock:
+            user = self.users.pop(nick, None)
+            if user is None:
+                return None
+            if self.addresses.get(user.address) == nick:
+                del self.addresses[user.address]
+        # a join racing this one sees the user gone and undoes itself, see join()
+        for room in list(user.rooms):
+            lock = self.room_locks.get(room)
+            if lock is None:
+                continue
+            with lock:
+                members = self.rooms.get(room)
+                if members is not None:
+                    self._forget(nick, room, members)
+        return user
+
+    def create_room(self, room):
+        """:return: False when the room exists"""
+        with self.lock:
+            if room in self.rooms:
+                return False
+            room = sys.intern(room)
+            # the lock first, whoever finds the room finds its lock
+            self.room_locks[room] = threading.Lock()
+            self.rooms[room] = set()
+            return True
+
+    def destroy_room(self, room):
+        """
+        remove a room and take it off its members' room lists
+
+        :return: False when there is no such room
+        """
+        with self.lock:
+            members = self.rooms.pop(room, None)
+            if members is None:
+                return False
+            lock = self.room_locks.pop(room)
+        # joins and leaves already holding the room's lock finish first
+        with lock:
+            for nick in members:
+                user = self.users.get(nick)
+                if user is not None:
+                    user.leave_room(room)
+        return True
+
+    def join(self, user, room):
+        """
+        add user to a room, keeping User.rooms and the room's members in step
+
+        :return: False when the room or the user is gone
+        """
+        lock = self.room_locks.get(room)
+        if lock is None:
+            return False
+        with lock:
+            members = self.rooms.get(room)
+            if members is None or self.room_locks.get(room) is not lock:
+                return False
+            user.join_room(room)
+            members.add(user.nick)
+            # drop_user() may have read User.rooms before the join got there
+            if self.users.get(user.nick) is not user:
+                user.leave_room(room)
+                self._forget(user.nick, room, members)
+                return False
+            return True
+
+    def leave(self, user, room):
+        """
+        remove user from a room, keeping User.rooms and the room's members in step
+
+        :return: False when the room is gone
+        """
+        lock = self.room_locks.get(room)
+        if lock is None:
+            return False
+        with lock:
+            members = self.rooms.get(room)
+            if members is None or self.room_locks.get(room) is not lock:
+                return False
+            user.leave_room(room)
+            self._forget(user.nick, room, members)
+            return True
+
+    def _forget(self, nick, room, members):
+        """
+        take a nick out of a room's members, unless the user now holding the
+        nick is in the room, a new user with the nick of one that is gone may
+        have joined it since. Called under the room's lock.
+        """
+        user = self.users.get(nick)
+        if user is None or room not in user.rooms:
+            members.discard(nick)
+
+    def load(self, rooms, users):
+        """
+        fill the store in bulk without taking any lock, for restoring a snapshot
+        before serving while nothing else can reach the store
+
+        :param rooms: names of rooms to create, those that exist are kept
+        :param users: (User, rooms to join) pairs, the User not in any room yet.
+                      A user whose nick is taken is skipped, as are rooms that do not exist
+        :return: list of the Users added
+        """
+        for room in rooms:
+            if room not in self.rooms:
+                room = sys.intern(room)
+                self.room_locks[room] = threading.Lock()
+                self.rooms[room] = set()
+        added = []
+        for user, user_rooms in users:
+            nick = user.nick
+            if nick in self.users:
+                continue
+            self.users[nick] = user
+            if user.worker is None:
+                self.addresses[user.address] = nick
+            for room in user_rooms:
+                members = self.rooms.get(room)
+                if members is not None:
+                    user.join_room(room)
+                    members.add(nick)
+            added.append(user)
+        return added
+
+    def members(self, room):
+        """:return: a copy of the nicks in a room, empty when there is no such room"""
+        lock = self.room_locks.get(room)
+        if lock is None:
+            return ()
+        with lock:
+            return tuple(self.rooms.get(room, ()))
+
+    def check(self):
+        """
+        :return: every way users, rooms and addresses disagree, empty when they are
+                 consistent. Only meaningful while nothing is changing the store
+        """
+        problems = []
+        for room, members in self.rooms.items():
+            if room not in self.room_locks:
+                problems.append("room {} has no lock".format(room))
+            for nick in members:
+                user = self.users.get(nick)
+                if user is None or room not in user.rooms:
+                    problems.append("{} is listed in {} but not in it".format(nick, room))
+        for nick, user in self.users.items():
+            if user.worker is None and self.addresses.get(user.address) != nick:
+                problems.append("{} is not indexed by address".format(nick))
+            for room in user.rooms:
+                if nick not in self.rooms.get(room, ()):
+                    problems.append("{} is in {} but not listed".format(nick, room))
+            if len(set(user.rooms)) != len(user.rooms):
+                problems.append("{} has a room twice".format(nick))
+        if len(self.addresses) != sum(1 for user in self.users.values() if user.worker is None):
+            problems.append("{} addresses for {} users".format(len(self.addresses), len(self.users)))
+        return problems
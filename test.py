@@ -2,70 +2,69 @@
 This file is used for testing each packet separately, and ensure that each
 packet gets handled properly in various simple scenarios.
 
+The packets go to a running server over one session, pipelined in a single
+write, and each response is printed once it is matched to its request, so
+there is nothing to sleep for. loadgen.py measures throughput and latency.
 """
 
-from time import sleep
-import protocol
 import socket
+import client
+import protocol
 
 target_host = '0.0.0.0'
 target_port = 9999
 
 
-def test_packet(packet):
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.settimeout(2)
-    s.connect((target_host, target_port))
-    s.send(packet.encode())
-    for response in s.makefile('r'):
-        response = response.encode()
-        if protocol.decode(response).status == protocol.Status.OK:
-            print(protocol.decode(response).status)
-        elif protocol.decode(response).status == protocol.Status.ERR:
-            print(protocol.decode(response).err)
-    s.close()
-    sleep(1)  # sleep 1 sec before testing next packet.
-
-
-def test_multiple_packets(packets):
-    for packet in packets:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(2)
-        s.connect((target_host, target_port))
-        s.send(packet.encode())
-        for response in s.makefile('r'):
-            response = response.encode()
-
-            if protocol.decode(response).status == protocol.Status.OK:
-                print(protocol.decode(response).status)
-            elif protocol.decode(response).status == protocol.Status.ERR:
-                print(protocol.decode(response).err)
-        s.close()
-        sleep(1)
+def print_response(response):
+    if response.status == protocol.Status.OK:
+        print(response.status)
+    elif response.status == protocol.Status.ERR:
+        print(response.err)
+
+
+def open_session(username):
+    """connect username in session mode and print the Connect response"""
+    sock = socket.create_connection((target_host, target_port))
+    rfile = sock.makefile('rb')
+    sock.sendall(protocol.Connect(username, {"mode": protocol.SESSION}).encode())
+    print_response(protocol.decode(protocol.read_frame(rfile)))
+    client.USERNAME = username
+    session = client.Session(sock, rfile)
+    session.start()
+    return session
+
+
+def test_packets(session, packets):
+    """send packets in one write and print each response, in request order"""
+    for pending in session.submit_many(packets):
+        print_response(pending.wait())
 
 
 if __name__ == '__main__':
 
     # test connection should be OK
-    test_packet(protocol.Connect('lisa', {}))
+    session = open_session('lisa')
 
-    # test connection should be ERR
-    test_packet(protocol.Connect('lisa', {}))
+    test_packets(session, [
+        # test connection should be ERR
+        protocol.Connect('lisa', {}),
 
-    # test disconnection should be OK
-    test_packet(protocol.Disconnect("lisa"))
+        # test disconnection should be ERR
+        protocol.Disconnect("non-existent-user"),
 
-    # test disconnection should be ERR
-    test_packet(protocol.Disconnect("non-existent-user"))
+        # test create room should be OK
+        protocol.Create("room"),
 
-    # test create room should be OK
-    test_packet(protocol.Create("room"))
+        # test create room should be ERR
+        protocol.Create("room"),
 
-    # test create room should be ERR
-    test_packet(protocol.Create("room"))
+        # test destroy room should be OK
+        protocol.Destroy("room"),
 
-    # test destroy room should be OK
-    test_packet(protocol.Destroy("room"))
+        # test destroy room should be ERR
+        protocol.Destroy("room"),
+    ])
 
-    # test destroy room should be ERR
-    test_packet(protocol.Destroy("room"))
+    # test disconnection should be OK, the server then ends the session
+    session.closing = True
+    test_packets(session, [protocol.Disconnect("lisa")])
@@ -0,0 +1,201 @@
+"""
+Tests for the codec: every packet type through both wire formats, and the
+StreamDecoder however the stream is cut into chunks.
+"""
+
+import io
+import random
+import unittest
+import protocol
+from protocol import Status, WIRE_TEXT, WIRE_BINARY
+
+
+def listed(room, names):
+    """a LIST response, built the way the server builds one"""
+    packet = protocol.List(room, status=Status.OK)
+    packet.response = " ".join(names)
+    packet.length = len(names)
+    return packet
+
+
+PACKETS = [
+    protocol.Connect("alice", {"mode": protocol.SESSION, "wire": "2"}),
+    protocol.Connect("alice", {}, status=Status.OK),
+    protocol.Connect("alice", {}, status=Status.ERR, err="nick taken"),
+    protocol.Disconnect("alice"),
+    protocol.Disconnect("alice", status=Status.OK),
+    protocol.Message("alice", "hello there world", "room"),
+    protocol.Message("alice", "hi", "room", status=Status.OK),
+    protocol.Message("alice", "hi", "room", status=Status.ERR, err=protocol.rate_limited(1.5)),
+    protocol.PrivateMessage("alice", "psst over here", "bob"),
+    protocol.PrivateMessage("alice", "psst", "bob", status=Status.ERR, err="no such user"),
+    protocol.Broadcast("alice", "hey all", ["a", "b"]),
+    protocol.Broadcast("alice", "hey", ["a"], status=Status.OK),
+    protocol.List(),
+    protocol.List("room"),
+    listed(None, ["a", "b", "c"]),
+    listed("room", ["alice", "bob"]),
+    protocol.List("room", status=Status.ERR, err="no such room"),
+    protocol.Join("alice", "room"),
+    protocol.Join("alice", "room", status=Status.ERR, err="no such room"),
+    protocol.Leave("alice", "room"),
+    protocol.Leave("alice", "room", status=Status.OK),
+    protocol.Create("room"),
+    protocol.Create("room", status=Status.ERR, err="room exists"),
+    protocol.Destroy("room"),
+    protocol.Destroy("room", status=Status.OK),
+    protocol.Stats(),
+    protocol.Stats(["users=1", "rooms=2"], status=Status.OK),
+    protocol.Ping("alice"),
+    protocol.Pong("alice", status=Status.OK),
+]
+
+
+def fields(packet):
+    """:return: a packet's fields as a dict, a LIST response as the list of names it carries"""
+    values = {}
+    for cls in type(packet).__mro__:
+        for name in getattr(cls, "__slots__", ()):
+            values[name] = getattr(packet, name)
+    if isinstance(values.get("response"), str) and packet.opcode == protocol.Opcode.LIST:
+        values["response"] = values["response"].split(" ")
+    return values
+
+
+def stream(wires=(WIRE_TEXT, WIRE_BINARY)):
+    """:return: every packet encoded in each wire in turn, the frames one after another"""
+    return [protocol.encode(packet, wire) for packet in PACKETS for wire in wires]
+
+
+def cut(data, points):
+    """:return: data split at each of points"""
+    points = sorted(set(points))
+    return [data[i:j] for i, j in zip([0] + points, points + [len(data)])]
+
+
+class CodecTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        for wire in (WIRE_TEXT, WIRE_BINARY):
+            for packet in PACKETS:
+                frame = protocol.encode(packet, wire)
+                with self.subTest(wire=wire, packet=packet):
+                    self.assertEqual(protocol.wire_of(frame), wire)
+                    self.assertEqual(fields(protocol.decode(frame)), fields(packet))
+
+    def test_read_frame(self):
+        frames = stream()
+        rfile = io.BytesIO(b"".join(frames))
+        for frame in frames:
+            self.assertEqual(protocol.read_frame(rfile), frame)
+        self.assertEqual(protocol.read_frame(rfile), b"")
+
+
+class StreamDecoderTest(unittest.TestCase):
+
+    def decode(self, chunks, **kwargs):
+        decoder = protocol.StreamDecoder(**kwargs)
+        frames = []
+        for chunk in chunks:
+            frames.extend(decoder.feed(chunk))
+        self.assertEqual(bytes(decoder.buffer), b"")
+        return frames
+
+    def test_any_split(self):
+        frames = stream()
+        data = b"".join(frames)
+        self.assertEqual(self.decode([data]), frames)
+        self.assertEqual(self.decode([data[i:i + 1] for i in range(len(data))]), frames)
+        for size in (2, 3, 5, 7, 64):
+            self.assertEqual(self.decode([data[i:i + size] for i in range(0, len(data), size)]), frames)
+        rnd = random.Random(0)
+        for _ in range(200):
+            points = rnd.sample(range(1, len(data)), rnd.randint(1, 20))
+            self.assertEqual(self.decode(cut(data, points)), frames)
+
+    def test_every_boundary_of_a_v2_frame(self):
+        frame = protocol.encode(protocol.Message("alice", "hello", "room"), WIRE_BINARY)
+        for i in range(1, len(frame)):
+            self.assertEqual(self.decode([frame[:i], frame[i:] + frame]), [frame, frame])
+
+    def test_partial_frame_kept(self):
+        frame = protocol.encode(protocol.Ping("alice"), WIRE_BINARY)
+        decoder = protocol.StreamDecoder()
+        self.assertEqual(list(decoder.feed(frame[:3])), [])
+        self.assertEqual(list(decoder.feed(frame[3:-1])), [])
+        self.assertEqual(list(decoder.feed(frame[-1:])), [frame])
+
+    def test_line_at_the_limit(self):
+        line = b"PING " + b"a" * 58 + b"\n"
+        self.assertEqual(len(line), 64)
+        self.assertEqual(self.decode([line[:10], line[10:]], max_frame_size=64), [line])
+
+    def test_line_over_the_limit(self):
+        line = b"PING " + b"a" * 59 + b"\n"
+        # whole, and without its newline yet
+        for data in (line, line[:-1]):
+            decoder = protocol.StreamDecoder(max_frame_size=64)
+            with self.assertRaises(protocol.FrameError):
+                list(decoder.feed(data))
+
+    def test_frame_over_the_limit(self):
+        frame = protocol.encode(protocol.Message("alice", "a" * 100, "room"), WIRE_BINARY)
+        decoder = protocol.StreamDecoder(max_frame_size=64)
+        # refused from its prefix, before the rest arrives
+        with self.assertRaises(protocol.FrameError):
+            list(decoder.feed(frame[:protocol.V2_PREFIX.size]))
+
+    def test_frames_before_one_over_the_limit(self):
+        ok = protocol.encode(protocol.Ping("alice"))
+        decoder = protocol.StreamDecoder(max_frame_size=64)
+        frames = []
+        with self.assertRaises(protocol.FrameError):
+            for frame in decoder.feed(ok + b"x" * 100):
+                frames.append(frame)
+        self.assertEqual(frames, [ok])
+
+
+class CompressionTest(unittest.TestCase):
+
+    def compressed(self, frames):
+        """:return: frames as a Deflater sends them, each flushed on its own"""
+        deflater = protocol.Deflater()
+        return b"".join(deflater.compress(frame) for frame in frames)
+
+    def decode(self, first, chunks, **kwargs):
+        """decode a stream that is plain up to and including first, compressed after it"""
+        decoder = protocol.StreamDecoder(**kwargs)
+        frames = []
+        for chunk in chunks:
+            for frame in decoder.feed(chunk):
+                frames.append(frame)
+                if frame == first:
+                    decoder.inflate()
+        return frames
+
+    def test_inflate_any_split(self):
+        first = protocol.encode(protocol.Connect("alice", {"compress": protocol.COMPRESS_ZLIB}))
+        frames = stream()
+        data = first + self.compressed(frames)
+        self.assertEqual(self.decode(first, [data]), [first] + frames)
+        self.assertEqual(self.decode(first, [data[i:i + 1] for i in range(len(data))]), [first] + frames)
+        rnd = random.Random(0)
+        for _ in range(200):
+            points = rnd.sample(range(1, len(data)), rnd.randint(1, 20))
+            self.assertEqual(self.decode(first, cut(data, points)), [first] + frames)
+
+    def test_inflate_past_the_limit(self):
+        # frames that each fit, which inflate to many times the limit together
+        first = protocol.encode(protocol.Connect("alice", {}))
+        frames = [protocol.encode(protocol.Ping("alice"), wire) for wire in (WIRE_TEXT, WIRE_BINARY)] * 200
+        data = first + self.compressed(frames)
+        self.assertEqual(self.decode(first, [data], max_frame_size=64), [first] + frames)
+
+    def test_bad_compressed_stream(self):
+        first = protocol.encode(protocol.Connect("alice", {}))
+        with self.assertRaises(protocol.FrameError):
+            self.decode(first, [first + b"not zlib at all"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,269 @@
+"""
+Tests that run server.py in a process of its own and talk to it over loopback.
+"""
+
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import protocol
+from protocol import Status
+
+HOST = "127.0.0.1"
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, *args, log=subprocess.DEVNULL):
+    """
+    start server.py with args and wait until it accepts connections
+
+    :param log: the file the server logs to
+    """
+    proc = subprocess.Popen([sys.executable, SERVER, "--host", HOST, "--port", str(port),
+                             "--log-level", "WARNING"] + list(args),
+                            stdout=subprocess.DEVNULL, stderr=log)
+    for _ in range(100):
+        try:
+            socket.create_connection((HOST, port), timeout=0.1).close()
+            return proc
+        except socket.error:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+def stop_server(proc):
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def request(port, packet, source_port=0):
+    """
+    send a packet on a connection of its own, as a legacy client does
+
+    :param source_port: the port to send from, 0 for any
+    :return: the response
+    """
+    s = socket.socket()
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        s.bind((HOST, source_port))
+        s.settimeout(5)
+        s.connect((HOST, port))
+        s.sendall(packet.encode())
+        rfile = s.makefile("rb")
+        response = protocol.decode(protocol.read_frame(rfile))
+        # the server hangs up first, so the source port can be used again
+        rfile.read()
+        return response
+    finally:
+        s.close()
+
+
+class Listener(object):
+    """the listener a legacy client keeps for the server to dial back, it collects what is delivered"""
+
+    def __init__(self, port):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((HOST, port))
+        self.sock.listen()
+        self.packets = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._read, args=(conn,), daemon=True).start()
+
+    def _read(self, conn):
+        rfile = conn.makefile("rb")
+        while True:
+            frame = protocol.read_frame(rfile)
+            if not frame:
+                return
+            self.packets.append(protocol.decode(frame))
+
+    def messages(self):
+        return [packet.message for packet in list(self.packets) if packet.opcode == protocol.Opcode.MSG]
+
+    def close(self):
+        self.sock.close()
+
+
+def stats(response):
+    """:return: a STATS response's tokens as a dict"""
+    return dict(token.split("=", 1) for token in response.response)
+
+
+class EvictionTest(unittest.TestCase):
+    """a server of one process"""
+
+    def setUp(self):
+        self.port = free_port()
+        self.proc = start_server(self.port)
+        self.addCleanup(stop_server, self.proc)
+
+    def test_unreachable_user_not_counted_as_overflow(self):
+        bob = Listener(free_port())
+        self.addCleanup(bob.close)
+        source_port = bob.sock.getsockname()[1] - 100
+        self.assertEqual(request(self.port, protocol.Connect("bob", {}), source_port).status, Status.OK)
+        # alice listens nowhere, the first delivery to her finds no listener
+        self.assertEqual(request(self.port, protocol.Connect("alice", {})).status, Status.OK)
+        self.assertEqual(request(self.port, protocol.PrivateMessage("bob", "hi", "alice")).status, Status.OK)
+
+        for _ in range(50):
+            counters = stats(request(self.port, protocol.Stats()))
+            if counters["users"] == "1":
+                break
+            time.sleep(0.1)
+        self.assertEqual(counters["users"], "1")
+        self.assertEqual(counters["evicted.unreachable"], "1")
+        self.assertEqual(counters["evicted.timeout"], "0")
+        self.assertEqual(counters["outbox.evicted"], "0")
+
+
+class BadPacketTest(unittest.TestCase):
+    """a malformed packet is logged and ends its connection, on each engine"""
+
+    ENGINE = "threads"
+
+    def setUp(self):
+        self.port = free_port()
+        self.log = tempfile.TemporaryFile()
+        self.addCleanup(self.log.close)
+        self.proc = start_server(self.port, "--engine", self.ENGINE, log=self.log)
+        self.addCleanup(stop_server, self.proc)
+
+    def test_bad_packet_closes_the_session(self):
+        with socket.create_connection((HOST, self.port), timeout=5) as s:
+            rfile = s.makefile("rb")
+            s.sendall(protocol.Connect("alice", {"mode": protocol.SESSION}).encode())
+            self.assertEqual(protocol.decode(protocol.read_frame(rfile)).status, Status.OK)
+            s.sendall(b"MSG alice not-a-length\n")
+            self.assertEqual(rfile.read(), b"")
+
+        self.assertEqual(stats(request(self.port, protocol.Stats()))["users"], "0")
+        stop_server(self.proc)
+        self.log.seek(0)
+        log = self.log.read().decode()
+        self.assertIn("sent a bad packet", log)
+        self.assertNotIn("Exception occurred during processing", log)
+
+
+class AsyncBadPacketTest(BadPacketTest):
+
+    ENGINE = "asyncio"
+
+
+class WorkersTest(unittest.TestCase):
+    """a server of three worker processes, each connection is served by whichever the kernel picks"""
+
+    WORKERS = 3
+
+    def setUp(self):
+        self.port = free_port()
+        self.proc = start_server(self.port, "--workers", str(self.WORKERS))
+        self.addCleanup(stop_server, self.proc)
+        self.source_ports = self._source_ports()
+
+    def _source_ports(self):
+        """
+        SO_REUSEPORT picks the worker from the connection's addresses, so a
+        given source port always reaches the same worker
+
+        :return: {worker: [source port, ...]}
+        """
+        ports = {}
+        base = free_port()
+        for source_port in range(base, base + 400):
+            if source_port >= 65000:
+                break
+            try:
+                worker = stats(request(self.port, protocol.Stats(), source_port))["worker"]
+            except OSError:
+                continue
+            ports.setdefault(int(worker), []).append(source_port)
+            if len(ports) == self.WORKERS and all(len(p) >= 20 for p in ports.values()):
+                break
+        self.assertEqual(len(ports), self.WORKERS, "could not reach every worker")
+        return ports
+
+    def on(self, worker, packet):
+        """send packet through worker, each time from a source port not used before"""
+        return request(self.port, packet, self.source_ports[worker].pop())
+
+    def wait_for_users(self, expected):
+        """:return: each worker's users= once every worker agrees on it, or after a few seconds"""
+        for _ in range(50):
+            counts = [int(stats(self.on(worker, protocol.Stats()))["users"]) for worker in range(self.WORKERS)]
+            if counts == [expected] * self.WORKERS:
+                break
+            time.sleep(0.1)
+        return counts
+
+    def test_disconnect_through_another_worker(self):
+        self.assertEqual(self.on(0, protocol.Connect("alice", {})).status, Status.OK)
+        self.assertEqual(self.wait_for_users(1), [1] * self.WORKERS)
+
+        self.assertEqual(self.on(1, protocol.Disconnect("alice")).status, Status.OK)
+        self.assertEqual(self.wait_for_users(0), [0] * self.WORKERS)
+
+        # the nick is free everywhere, and once taken again it has exactly one owner
+        self.assertEqual(self.on(2, protocol.Connect("alice", {})).status, Status.OK)
+        self.assertEqual(self.wait_for_users(1), [1] * self.WORKERS)
+        for worker in range(self.WORKERS):
+            self.assertEqual(self.on(worker, protocol.Connect("alice", {})).status, Status.ERR)
+
+    def connect(self, worker, nick):
+        """connect nick as a legacy user of worker, :return: their Listener"""
+        source_port = self.source_ports[worker].pop()
+        listener = Listener(source_port + 100)
+        self.addCleanup(listener.close)
+        self.assertEqual(request(self.port, protocol.Connect(nick, {}), source_port).status, Status.OK)
+        return listener
+
+    def wait_for(self, condition):
+        for _ in range(50):
+            if condition():
+                return True
+            time.sleep(0.1)
+        return False
+
+    def test_history_kept_by_workers_with_members(self):
+        self.connect(0, "alice")
+        bob = self.connect(1, "bob")
+        self.assertEqual(self.on(0, protocol.Create("r")).status, Status.OK)
+        self.assertEqual(self.on(0, protocol.Join("alice", "r")).status, Status.OK)
+        self.assertTrue(self.wait_for(lambda: self.on(1, protocol.Join("bob", "r")).status == Status.OK))
+        self.assertTrue(self.wait_for(lambda: "bob" in self.on(0, protocol.List("r")).response))
+        self.assertEqual(self.on(0, protocol.Message("alice", "ping", "r")).status, Status.OK)
+        self.assertTrue(self.wait_for(lambda: "ping" in bob.messages()))
+
+        # worker 1 kept the message from the delivery to bob, so it can replay it
+        carol = self.connect(1, "carol")
+        self.assertTrue(self.wait_for(lambda: self.on(1, protocol.Join("carol", "r")).status == Status.OK))
+        self.assertTrue(self.wait_for(lambda: "ping" in carol.messages()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+"""
+Tests for the StateStore: its users, rooms and addresses must agree however
+handler threads interleave their changes.
+"""
+
+import random
+import sys
+import threading
+import unittest
+from state import StateStore
+from User import User
+
+NICKS = ["user{}".format(i) for i in range(32)]
+ROOMS = ["room{}".format(i) for i in range(8)]
+
+
+def address(nick):
+    return ("127.0.0.1", 1024 + NICKS.index(nick))
+
+
+def hammer(store, operations, seed):
+    """joins, leaves, users connecting and dropping and rooms coming and going, at random"""
+    rnd = random.Random(seed)
+    for _ in range(operations):
+        roll = rnd.random()
+        nick = rnd.choice(NICKS)
+        room = rnd.choice(ROOMS)
+        user = store.users.get(nick)
+        if roll < 0.2:
+            store.members(room)
+        elif roll < 0.5:
+            if user is not None:
+                store.join(user, room)
+        elif roll < 0.7:
+            if user is not None:
+                store.leave(user, room)
+        elif roll < 0.97:
+            if user is None:
+                store.add_user(User(nick, address(nick)))
+            else:
+                store.drop_user(nick)
+        elif not store.destroy_room(room):
+            store.create_room(room)
+
+
+class DroppedWhileJoining(User):
+    """a user dropped by another thread right as they join, after drop_user() read their rooms"""
+
+    __slots__ = ("store",)
+
+    def join_room(self, room):
+        self.store.drop_user(self.nick)
+        super(DroppedWhileJoining, self).join_room(room)
+
+
+class StateStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = StateStore()
+        for room in ROOMS:
+            self.store.create_room(room)
+
+    def test_concurrent_changes_stay_consistent(self):
+        interval = sys.getswitchinterval()
+        # switch threads as often as possible, to interleave inside the locked sections
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+        for round in range(20):
+            threads = [threading.Thread(target=hammer, args=(self.store, 2000, round * 8 + i))
+                       for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(self.store.check(), [], "round {}".format(round))
+
+    def test_join_undone_when_dropped_meanwhile(self):
+        user = DroppedWhileJoining("alice", address("user0"))
+        user.store = self.store
+        self.assertTrue(self.store.add_user(user))
+
+        self.assertFalse(self.store.join(user, "room0"))
+        self.assertNotIn("alice", self.store.users)
+        self.assertEqual(self.store.members("room0"), ())
+        self.assertEqual(user.rooms, [])
+        self.assertEqual(self.store.check(), [])
+
+    def test_stale_join_keeps_the_new_owner_of_the_nick(self):
+        old = User("alice", address("user0"))
+        self.assertTrue(self.store.add_user(old))
+        self.assertIs(self.store.drop_user("alice"), old)
+        new = User("alice", address("user1"))
+        self.assertTrue(self.store.add_user(new))
+        self.assertTrue(self.store.join(new, "room0"))
+
+        # a handler still holding the old User joins them late
+        self.assertFalse(self.store.join(old, "room0"))
+        self.assertEqual(self.store.members("room0"), ("alice",))
+        self.assertEqual(old.rooms, [])
+        self.assertEqual(new.rooms, ["room0"])
+        self.assertEqual(self.store.check(), [])
+
+    def test_check_reports_disagreement(self):
+        user = User("alice", address("user0"))
+        self.store.add_user(user)
+        user.join_room("room0")
+        self.assertEqual(self.store.check(), ["alice is in room0 but not listed"])
+
+
+if __name__ == "__main__":
+    unittest.main()
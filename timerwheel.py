@@ -0,0 +1,85 @@
+"""
+Timer wheel module - deadlines for many keys, expired in O(expired) per tick.
+
+A hashed timer wheel cuts time into ticks and keeps one slot per tick for a
+whole horizon, a key due at tick t sits in slot t % len(slots). Scheduling
+or cancelling a key is a set add and discard; advancing the wheel visits
+only the slots of the ticks that went by, and every key in them is due.
+Deadlines are kept to tick granularity, so rescheduling a key again within
+the same tick costs one dict lookup and takes no lock.
+"""
+
+import math
+import threading
+
+
+class TimerWheel(object):
+    """
+    Deadlines for hashable keys, no more than horizon seconds ahead.
+    Times are time.monotonic() seconds.
+    """
+
+    def __init__(self, tick, horizon, now):
+        """
+        :param tick: seconds per slot, deadlines are rounded up to a whole tick
+        :param horizon: the furthest ahead a deadline may be, in seconds
+        :param now: the current time
+        """
+        self.tick = tick
+        self.slots = [set() for _ in range(int(math.ceil(horizon / tick)) + 2)]
+        # key -> the tick it is due at
+        self.due = {}
+        self.current = int(now / tick)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.due)
+
+    def schedule(self, key, deadline):
+        """
+        set the time key expires at, replacing any earlier deadline
+
+        :param key: the key
+        :param deadline: when it expires
+        """
+        at = int(math.ceil(deadline / self.tick))
+        if self.due.get(key) == at:
+            return
+        with self.lock:
+            # never in a slot already passed, nor a whole turn of the wheel ahead
+            at = min(max(at, self.current + 1), self.current + len(self.slots) - 1)
+            old = self.due.get(key)
+            if old is not None:
+                self.slots[old % len(self.slots)].discard(key)
+            self.due[key] = at
+            self.slots[at % len(self.slots)].add(key)
+
+    def cancel(self, key):
+        """forget key, if it is scheduled"""
+        with self.lock:
+            old = self.due.pop(key, None)
+            if old is not None:
+                self.slots[old % len(self.slots)].discard(key)
+
+    def advance(self, now):
+        """
+        move the wheel on to now
+
+        :param now: the current time
+        :return: the keys that expired, they are no longer scheduled
+        """
+        expired = []
+        with self.lock:
+            target = int(now / self.tick)
+            # after a whole turn every slot has been visited once
+            self.current = max(self.current, target - len(self.slots))
+            while self.current < target:
+                self.current += 1
+                i = self.current % len(self.slots)
+                slot = self.slots[i]
+                if slot:
+                    self.slots[i] = set()
+                    for key in slot:
+                        del self.due[key]
+                    expired.extend(slot)
+        return expired